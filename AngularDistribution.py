@@ -6,8 +6,9 @@
 """
 
 import math
-from ROOT import TF1
+import numpy as np
 import unittest
+import Sampling
 
 
 def function_1 (x):
@@ -99,52 +100,56 @@ def function_10 (x):
         return 1473.86*math.exp(-x[0]/11.7009)
 
     
-def choose_angle_from_distribution(radius):
+RADIUS_BINS = np.array([12.5, 25.0, 37.5, 50.0, 62.5, 75.0, 87.5, 100.0, 112.5, 125.0])
+"""Upper edges of the bins of the radius (position of the photon respect to the center of the fiber).
+   The bins are closed on the right, each one has its own angular distribution."""
 
-    """
+ANGULAR_FUNCTIONS = [(function_1, 0, 27), (function_2, 0, 27), (function_3, 0, 27), (function_4, 0, 27),
+                     (function_5, 0, 27), (function_6, 0, 37), (function_7, 0, 44), (function_8, 0, 60),
+                     (function_9, 0, 86), (function_10, 0, 70)]
+"""Angular distribution (function, min angle, max angle) of each bin of :data:`RADIUS_BINS`. Angles in degrees."""
+
+
+def _buildAngleTable(npoints=2000):
+    """Tabulate all the angular distributions in one inverse cumulative table.
+
+       The cumulative distribution of the bin i is shifted by i, so the concatenation of the ten
+       cumulatives is increasing and a uniform number u of the bin i is inverted at u+i."""
+    cdf = []
+    angles = []
+    for i, (function, xmin, xmax) in enumerate(ANGULAR_FUNCTIONS):
+        x = np.linspace(xmin, xmax, npoints)
+        sampler = Sampling.InverseCDFSampler(x, [function([xi]) for xi in x])
+        cdf.append(sampler.cdf+i)
+        angles.append(sampler.x)
+    return np.concatenate(cdf), np.concatenate(angles)
 
-     Given the position of the photon rispect to the center of the fiber(radius), this function return us the emission angle
-     of the photons.Depending by the radius, a random number is returned from the distributions obtained by a Geant Simulation"""
-    #print radius
-    
-    angle=0
-    if radius>=0 and radius<=12.5:
-        f1=TF1("f1",function_1,0,27) 
-        angle=f1.GetRandom()
-    elif radius>12.5 and radius<=25:
-        f2=TF1("f2",function_2,0,27)
-        angle=f2.GetRandom()
-    elif radius>25 and radius<=37.5:
-        f1=TF1("f1",function_3,0,27) 
-        angle=f1.GetRandom()
-    elif radius>37.5 and radius<=50:
-        f1=TF1("f1",function_4,0,27) 
-        angle=f1.GetRandom()
-    elif radius>50 and radius<=62.5:
-        f1=TF1("f1",function_5,0,27) 
-        angle=f1.GetRandom()
-    elif radius>62.5 and radius<=75:
-        f1=TF1("f1",function_6,0,37) 
-        angle=f1.GetRandom()
-    elif radius>75 and radius<=87.5:
-        f1=TF1("f1",function_7,0,44) 
-        angle=f1.GetRandom()
-    elif radius>87.5 and radius<=100:
-        f1=TF1("f1",function_8,0,60) 
-        angle=f1.GetRandom()
-    elif radius>100 and radius<=112.5:
-        f1=TF1("f1",function_9,0,86) 
-        angle=f1.GetRandom()
-    elif radius>=112.5 and radius<=125:
-        f1=TF1("f1",function_10,0,70) 
-        angle=f1.GetRandom()
-   
-    #print angle
-    return math.radians(angle)
-
-       
 
+def getAngleTable():
+    """Returns the table (cumulative, angle) of :func:`_buildAngleTable`, computed once per process"""
+    return Sampling.getSampler('emission_angle', _buildAngleTable)
 
 
+def choose_angles_from_distribution(radius, rng=np.random):
 
+    """Vectorized version of :func:`choose_angle_from_distribution`.
 
+     Given an array of positions of the photons rispect to the center of the fiber (radius), returns the array of
+     the emission angles (in radians). Each radius is assigned to its bin with one searchsorted and all the angles
+     are drawn with one interpolation in the table of :func:`getAngleTable`. The angle is 0 for a radius out of the bins."""
+    radius = np.asarray(radius, dtype=float)
+    cdf, angles = getAngleTable()
+    bins = np.searchsorted(RADIUS_BINS, radius, side='left')
+    valid = (radius >= 0) & (bins < len(RADIUS_BINS))
+    angle = np.interp(rng.uniform(size=radius.shape)+bins, cdf, angles)
+    angle[~valid] = 0.0
+    return np.radians(angle)
+
+
+def choose_angle_from_distribution(radius):
+
+    """
+
+     Given the position of the photon rispect to the center of the fiber(radius), this function return us the emission angle
+     of the photons.Depending by the radius, a random number is returned from the distributions obtained by a Geant Simulation"""
+    return float(choose_angles_from_distribution([radius])[0])
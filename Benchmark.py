@@ -0,0 +1,170 @@
+# Benchmark module
+
+"""
+.. module:: Benchmark
+   :synopsis: Benchmarks of the stages of the simulation and of the scaling with the detector size
+
+Es: python Benchmark.py config.py -o bench.json
+    python Benchmark.py --compare bench_old.json bench_new.json
+
+The results are written in a JSON file. With --compare, the events per second of two files are compared
+and the exit status is 1 if a benchmark is slower than the tolerance allows.
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import numpy as np
+import AngularDistribution
+import FiberSetup
+import GenerateEvent
+import Kernels
+import MainSimulation
+
+
+def timeCall(function, repeat=5, number=1):
+    """Best time (in seconds) of one call of function, over repeat measurements of number calls"""
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        for j in range(number):
+            function()
+        elapsed = (timeit.default_timer()-start)/number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def configure(parameter, **values):
+    """Copy of the parameters with some values changed. When nfibers is changed, channel_number follows it."""
+    parameter = copy.copy(parameter)
+    if 'nfibers' in values and 'channel_number' not in values:
+        values['channel_number'] = values['nfibers']
+    for name, value in values.items():
+        setattr(parameter, name, value)
+    parameter.seed = 12345
+    parameter.nworkers = 1
+    parameter.instrumentation = False
+    return parameter
+
+
+def benchmarkStages(parameter, repeat=5):
+    """Time of each stage of the simulation with the parameters given"""
+    np.random.seed(1)
+    results = {}
+    results['setup_construction'] = timeCall(lambda: FiberSetup.Setup(parameter), repeat)
+
+    setup = FiberSetup.Setup(parameter, np.random.RandomState(1))
+    stack = setup.fiber_stack
+    layer = len(stack)//2
+    fiber = stack[layer][stack.shape[1]//2]
+    results['fiber_produce_photons'] = timeCall(lambda: fiber.producePhotons(0.01, fiber.Xc, fiber.Yc), repeat, 100)
+    results['stack_produce_photons'] = timeCall(lambda: stack.producePhotons(0.01, fiber.Xc, fiber.Yc), repeat, 100)
+
+    radius = np.random.uniform(0, 125, 1000)
+    results['choose_angle_from_distribution'] = timeCall(lambda: AngularDistribution.choose_angle_from_distribution(60.0), repeat, 100)
+    results['choose_angles_from_distribution_1000'] = timeCall(lambda: AngularDistribution.choose_angles_from_distribution(radius), repeat, 10)
+
+    channel_array = setup.getObjectChannel()
+    fiber.photons = 20
+    results['fill_pixels_20_photons'] = timeCall(lambda: channel_array.fillPixels(fiber), repeat, 100)
+    results['fill_channel_array'] = timeCall(channel_array.fillChannelArray, repeat, 100)
+    results['reset_array'] = timeCall(channel_array.resetArray, repeat, 100)
+    return results
+
+
+def benchmarkEvents(parameter, nevents, repeat=3):
+    """Events per second of a full run, one event at a time and in blocks"""
+    results = {}
+    for mode, block_size in (('events', 0), ('blocks', getattr(parameter, 'block_size', 0) or 1000)):
+        simul = GenerateEvent.Event(configure(parameter, block_size=block_size))
+        n = nevents if block_size else max(1, nevents//100)
+        results['%s_per_second' % mode] = n/timeCall(lambda: simul.run(n), repeat)
+    return results
+
+
+def runBenchmarks(parameter, sweep, nevents, repeat):
+    """Runs the stage and event benchmarks for each point of the sweep.
+       sweep is a list of dictionaries with the parameters changed in each point."""
+    results = []
+    for point in sweep:
+        point_parameter = configure(parameter, **point)
+        result = {'parameters': point}
+        result.update(benchmarkStages(point_parameter, repeat))
+        result.update(benchmarkEvents(point_parameter, nevents, repeat))
+        results.append(result)
+        sys.stderr.write('%s: %.0f events/s\n' % (point, result['blocks_per_second']))
+    return results
+
+
+def defaultSweep(quick=False):
+    """Points of the benchmark: scaling with layers, detector width (nfibers = channel_number) and theta_max"""
+    if quick:
+        return [{'layers': 5, 'nfibers': 128, 'theta_max': 2}]
+    sweep = [{'layers': layers, 'nfibers': 128, 'theta_max': 2} for layers in (3, 5, 6)]
+    sweep += [{'layers': 5, 'nfibers': nfibers, 'theta_max': 2} for nfibers in (512, 2048, 4096)]
+    sweep += [{'layers': 5, 'nfibers': 128, 'theta_max': theta_max} for theta_max in (10, 30)]
+    return sweep
+
+
+def describeEnvironment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'numba': Kernels.NUMBA_VERSION, 'machine': platform.machine(), 'node': platform.node()}
+
+
+def compare(old, new, tolerance):
+    """Compare the events per second of two benchmark files. Returns the list of the regressions."""
+    regressions = []
+    old_points = dict((json.dumps(result['parameters'], sort_keys=True), result) for result in old['results'])
+    for result in new['results']:
+        key = json.dumps(result['parameters'], sort_keys=True)
+        if key not in old_points:
+            continue
+        for name in ('events_per_second', 'blocks_per_second'):
+            ratio = result[name]/old_points[key][name]
+            print('%-50s %-18s %12.1f -> %12.1f  (%+.1f%%)' % (key, name, old_points[key][name], result[name], 100*(ratio-1)))
+            if ratio < 1-tolerance:
+                regressions.append((key, name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the simulation')
+    parser.add_argument('config', nargs='?', default='config.py', help='configuration file with the base parameters')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file of the results')
+    parser.add_argument('-n', '--nevents', type=int, default=20000, help='events of the full run benchmarks')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions of each measurement, the best is kept')
+    parser.add_argument('--quick', action='store_true', help='only the default detector')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files instead of running')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slow down accepted by --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.tolerance)
+        for key, name, ratio in regressions:
+            print('REGRESSION %s %s: %.1f%% slower' % (key, name, 100*(1-ratio)))
+        return 1 if regressions else 0
+
+    parameter = MainSimulation.Parameters(args.config)
+    results = {'environment': describeEnvironment(), 'nevents': args.nevents,
+               'results': runBenchmarks(parameter, defaultSweep(args.quick), args.nevents, args.repeat)}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Checkpoint module
+
+"""
+.. module:: Checkpoint
+   :synopsis: Checkpoints of the long runs, to resume them after an interruption
+
+A checkpoint is a directory with the events completed so far, stored by a :class:`OutputWriter.BinaryWriter`,
+and a file checkpoint.json with the number of events completed and the parameters of the run. checkpoint.json
+is replaced atomically and only after the events have been written to the disk, so after an interruption it
+always describes a complete part of the run. A checkpoint of a run that keeps no events (output format 'none')
+has only checkpoint.json, so its size does not depend on the number of events.
+"""
+import json
+import os
+import shutil
+import OutputWriter
+
+
+class Checkpoint(object):
+    """Checkpoint of a run in the directory dirname.
+
+       parameters is a dictionary with the parameters of the run: a checkpoint can be resumed only by a run with
+       the same parameters. The events are given to :func:`write` and :func:`save` records that all the events
+       written so far are complete. When the run is over, :func:`finish` copies the events in the final writer
+       and removes the directory. If keep_events is False the events are only counted, not stored."""
+
+    def __init__(self, dirname, columns, parameters, flush_every=10000, keep_events=True):
+
+        self.dirname = dirname
+        self.columns = columns
+        self.flush_every = flush_every
+        self.parameters = json.loads(json.dumps(parameters))
+        self.filename = os.path.join(dirname, 'checkpoint.json')
+        self.keep_events = keep_events
+        self.writer = None
+        self.nevents = 0
+
+    def load(self):
+        """Opens the checkpoint. Returns the state saved by the last :func:`save`, or None if there is no checkpoint
+           and the run starts from the beginning. A ValueError is raised if the checkpoint belongs to a run with
+           different parameters."""
+        state = None
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                state = json.load(f)
+            if state['parameters'] != self.parameters:
+                changed = sorted(name for name in set(state['parameters']) | set(self.parameters)
+                                 if state['parameters'].get(name) != self.parameters.get(name))
+                raise ValueError("the checkpoint in %s was made with different parameters (%s): remove it to start again"
+                                 % (self.dirname, ', '.join(changed)))
+        self.nevents = state['nevents'] if state else 0
+        if self.keep_events:
+            # the events after the last checkpoint, if any, are removed
+            self.writer = OutputWriter.BinaryWriter(os.path.join(self.dirname, 'events'), self.columns, self.flush_every, self.nevents)
+        elif not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        return state
+
+    def write(self, *values):
+        if self.writer is not None:
+            self.writer.write(*values)
+        self.nevents += len(values[0])
+
+    def save(self, **state):
+        """Writes to the disk the events given so far and then the state: the number of events is added to it"""
+        if self.writer is not None:
+            self.writer.sync()
+        state['nevents'] = self.nevents
+        state['parameters'] = self.parameters
+        with open(self.filename+'.tmp', 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.filename+'.tmp', self.filename)
+
+    def finish(self, writer, chunk_size=10000):
+        """Copies all the events of the checkpoint in writer and removes the checkpoint.
+
+           Only the files of the checkpoint (checkpoint.json and the events directory) are removed, and the directory
+           itself only if nothing else is left in it, so an existing directory can be used as checkpoint_dir."""
+        if self.writer is not None:
+            self.writer.close()
+            for chunk in OutputWriter.readBinaryChunks(self.writer.filename, chunk_size):
+                writer.write(*[chunk[name] for name, dtype, shape in self.columns])
+            # the chunks are views of the files of the checkpoint, so they are written before removing them
+            writer.flush()
+            shutil.rmtree(self.writer.filename)
+        for filename in (self.filename, self.filename+'.tmp'):
+            if os.path.exists(filename):
+                os.remove(filename)
+        if not os.listdir(self.dirname):
+            os.rmdir(self.dirname)
@@ -0,0 +1,217 @@
+# FastSimulation module
+
+"""
+.. module:: FastSimulation
+   :synopsis: Fast simulation of the detector response sampled from templates made with the full simulation
+
+Es: python FastSimulation.py config.py --validate 20000
+
+With the parameter simulation = 'fast', the pixels fired per channel of an event are not simulated photon by photon,
+but copied from an event of the full simulation with a similar track (see :class:`ResponseTemplates`). The templates
+are built the first time they are needed and saved in the directory fastsim_dir, in a file named after a hash of the
+parameters and of the geometry: the templates of different configurations are kept side by side, and a configuration
+that changes gets new templates.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import Instrumentation
+import RandomService
+import Statistics
+
+VERSION = 1
+"""Version of the templates, part of the hash"""
+
+RESPONSE_PARAMETERS = ('layers', 'nfibers', 'diameter', 'fiber_gap', 'channel_number', 'ch_width', 'ch_height', 'dead_zone',
+                       'epoxy', 'prob_pde', 'pixel_x_size', 'pixel_y_size', 'epoxy_index', 'theta_max', 'sampler_backend',
+                       'crosstalk_prob', 'crosstalk_distance')
+"""Parameters that change the response of the detector, and so the templates"""
+
+TEMPLATE_OPTIONS = (('fastsim_theta_bins', 10), ('fastsim_phase_bins', 14), ('fastsim_channel_bins', 5), ('fastsim_samples', 200),
+                    ('fastsim_window', 4))
+"""Parameters of the templates, with their default values: bins of theta, of the phase in the fiber pitch and in the channel,
+events per bin and half width of the window"""
+
+
+class ResponseTemplates(object):
+    """Templates of the response of the detector.
+
+       The tracks are binned in ntheta bins of theta, in nphase bins of the position X0 modulo the fiber pitch
+       (diameter+fiber_gap), measured from the first fiber of the stack, and in nchannel_phase bins of X0 modulo the
+       channel width, since the fibers hit and the channels that collect their light both depend on X0. For each bin,
+       nsamples events of the full simulation are stored, each as the pixels fired in the 2*window+1 channels around the
+       channel of X0. An event of the fast simulation takes one of these samples at random, so the correlations between
+       the channels and the fluctuations of the full simulation are kept."""
+
+    def __init__(self, templates, theta_max, pitch, offset, channel_width, key):
+
+        self.templates = templates
+        self.ntheta, self.nphase, self.nchannel_phase, self.nsamples, width = templates.shape
+        self.window = width//2
+        self.theta_max = theta_max
+        self.pitch = pitch
+        self.offset = offset
+        self.channel_width = channel_width
+        self.key = key
+
+    @classmethod
+    def build(cls, setup, theta_max, key, ntheta=10, nphase=14, nchannel_phase=5, nsamples=200, window=4, rng=np.random,
+              block_size=10000):
+        """Builds the templates with the full simulation of setup (:func:`FiberSetup.Setup.simulateBlock`).
+           The events of each bin have theta and the phase in the fiber pitch uniform in the bin, and X0 on the fiber period
+           that gives the phase in the channel closest to a value drawn uniformly in the bin, among the periods far enough
+           from the edges of the detector for all the channels of the window to exist."""
+        channel_array = setup.getObjectChannel()
+        channel_width = channel_array.channel_width
+        pitch = setup.diameter+setup.gap
+        offset = setup.fiber_stack.Xc[0, 0]
+        first = int(np.ceil(((window+1)*channel_width-offset)/pitch))
+        last = int(np.floor(((channel_array.channel_number-window-1)*channel_width-offset)/pitch))-1
+        if last < first:
+            raise ValueError("the detector is too small for a window of %d channels" % window)
+        periods = np.arange(first, last+1)
+        nbins = ntheta*nphase*nchannel_phase
+        bins = np.repeat(np.arange(nbins), nsamples)
+        theta_bin, phase_bin, channel_bin = np.unravel_index(bins, (ntheta, nphase, nchannel_phase))
+        theta = (theta_bin+rng.uniform(size=len(bins)))*theta_max/ntheta
+        phase = (phase_bin+rng.uniform(size=len(bins)))*pitch/nphase
+        channel_phase = (channel_bin+rng.uniform(size=len(bins)))*channel_width/nchannel_phase
+        X0 = np.empty(len(bins))
+        for start in range(0, len(bins), block_size):
+            stop = min(start+block_size, len(bins))
+            candidates = offset+periods*pitch+phase[start:stop, np.newaxis]
+            distance = np.abs(np.mod(candidates-channel_phase[start:stop, np.newaxis]+channel_width/2, channel_width)-channel_width/2)
+            # the periods with the same phase in the channel (within 1 nm) are equivalent, one is taken at random
+            distance = np.round(distance*1e9)+rng.uniform(size=distance.shape)
+            X0[start:stop] = candidates[np.arange(stop-start), np.argmin(distance, axis=1)]
+        columns = np.floor(X0/channel_width).astype(int)[:, np.newaxis]+np.arange(-window, window+1)
+        samples = np.empty((len(X0), 2*window+1), dtype=np.int32)
+        # the events of the templates are not counted in the statistics and in the instrumentation of the run
+        statistics, instrumentation = setup.statistics, setup.instrumentation
+        setup.setStatistics(Statistics.NULL)
+        setup.setInstrumentation(Instrumentation.NULL)
+        try:
+            for start in range(0, len(X0), block_size):
+                stop = min(start+block_size, len(X0))
+                response = setup.simulateBlock(theta[start:stop], X0[start:stop], 0, rng)
+                samples[start:stop] = response[np.arange(stop-start)[:, np.newaxis], columns[start:stop]]
+        finally:
+            setup.setStatistics(statistics)
+            setup.setInstrumentation(instrumentation)
+        return cls(samples.reshape(ntheta, nphase, nchannel_phase, nsamples, 2*window+1), theta_max, pitch, offset, channel_width, key)
+
+    def save(self, filename):
+        """Saves the templates in the npz file filename, replacing it atomically. The file is written first with a unique
+           temporary name in the same directory, so several processes can save the same templates at the same time."""
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                np.savez_compressed(f, templates=self.templates, theta_max=self.theta_max, pitch=self.pitch, offset=self.offset,
+                                    channel_width=self.channel_width, key=self.key)
+            os.rename(temporary, filename)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['templates'], float(data['theta_max']), float(data['pitch']), float(data['offset']),
+                       float(data['channel_width']), str(data['key']))
+
+    def simulateBlock(self, Theta, X0, channel_number, rng=np.random):
+        """Fast simulation of a block of events: returns the matrix (events x channel_number) of the pixels fired per channel"""
+        Theta = np.asarray(Theta, dtype=float)
+        X0 = np.asarray(X0, dtype=float)
+        nevents = len(X0)
+        theta_bin = np.clip((Theta/self.theta_max*self.ntheta).astype(int), 0, self.ntheta-1)
+        phase_bin = np.clip((np.mod(X0-self.offset, self.pitch)/self.pitch*self.nphase).astype(int), 0, self.nphase-1)
+        channel_bin = np.clip((np.mod(X0, self.channel_width)/self.channel_width*self.nchannel_phase).astype(int), 0, self.nchannel_phase-1)
+        sample = np.minimum((rng.uniform(size=nevents)*self.nsamples).astype(int), self.nsamples-1)
+        values = self.templates[theta_bin, phase_bin, channel_bin, sample]
+        columns = np.floor(X0/self.channel_width).astype(int)[:, np.newaxis]+np.arange(-self.window, self.window+1)
+        inside = (columns >= 0) & (columns < channel_number)
+        response = np.zeros((nevents, channel_number), dtype=int)
+        response[np.nonzero(inside)[0], columns[inside]] = values[inside]
+        return response
+
+
+def templateKey(parameter, setup):
+    """Hash of the parameters of the response, of the options of the templates and of the positions of the fibers"""
+    values = dict((name, getattr(parameter, name, None)) for name in RESPONSE_PARAMETERS)
+    values.update(dict((name, getattr(parameter, name, default)) for name, default in TEMPLATE_OPTIONS))
+    values['version'] = VERSION
+    digest = hashlib.sha1(json.dumps(values, sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(setup.fiber_stack.Xc).tobytes())
+    digest.update(np.ascontiguousarray(setup.fiber_stack.Yc).tobytes())
+    return digest.hexdigest()
+
+
+def templateFile(parameter, key):
+    """File of the templates with the hash key, in the directory fastsim_dir (created if needed)"""
+    dirname = getattr(parameter, 'fastsim_dir', 'FastSimTemplates')
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+    return os.path.join(dirname, key+'.npz')
+
+
+def getTemplates(parameter, setup, seed):
+    """Returns the templates for parameter and setup: the ones in the file <hash>.npz of the directory fastsim_dir if it
+       exists, otherwise new ones, built with the random stream of the templates of the seed and saved in that file."""
+    key = templateKey(parameter, setup)
+    filename = templateFile(parameter, key)
+    if os.path.exists(filename):
+        templates = ResponseTemplates.load(filename)
+        if templates.key == key:
+            return templates
+    rng = RandomService.RandomStream(RandomService.createGenerator(seed, RandomService.TEMPLATES, 0))
+    options = [getattr(parameter, name, default) for name, default in TEMPLATE_OPTIONS]
+    templates = ResponseTemplates.build(setup, parameter.theta_max*np.pi/180.0, key, *options, rng=rng)
+    templates.save(filename)
+    return templates
+
+
+def summarize(response, X0, channel_width):
+    """Quantities compared by :func:`main` between the full and the fast simulation"""
+    import Reconstruction
+    total = response.sum(axis=1)
+    events = Reconstruction.reconstructEvents(response, channel_width)
+    found = events['nclusters'] > 0
+    residual = events['position'][found]-X0[found]
+    return {'mean pixels fired': total.mean(), 'std pixels fired': total.std(), 'efficiency': found.mean(),
+            'mean cluster size': events['size'][found].mean(), 'residual std (um)': residual.std()*1e6}
+
+
+def main(argv=None):
+    import copy
+    import GenerateEvent
+    import MainSimulation
+    parser = argparse.ArgumentParser(description='Builds the templates of the fast simulation and compares it with the full one')
+    parser.add_argument('config', help='configuration file of the simulation')
+    parser.add_argument('--validate', type=int, default=0, metavar='NEVENTS', help='events simulated with both the simulations')
+    args = parser.parse_args(argv)
+
+    parameter = MainSimulation.Parameters(args.config)
+    parameter.simulation = 'fast'
+    fast = GenerateEvent.Event(parameter)
+    print('templates in %s' % templateFile(parameter, fast.templates.key))
+    if args.validate:
+        full_parameter = copy.copy(parameter)
+        full_parameter.simulation = 'full'
+        width = fast.setup.getObjectChannel().channel_width
+        results = [summarize(response, X0, width) for theta, X0, response in
+                   (GenerateEvent.Event(full_parameter).run(args.validate), fast.run(args.validate))]
+        for name in sorted(results[0]):
+            print('%-20s full %10.4f   fast %10.4f' % (name, results[0][name], results[1][name]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,98 @@
 """
 import numpy as np
 import math
-import random
-import ROOT
 import Sipm
-import MainSimulation
+import Sampling
+import Instrumentation
+import Statistics
+
+
+CORE_INDEX = 1.59
+"""Refraction index of the core material of the fibers"""
+
+GEOMETRY_PARAMETERS = ('layers', 'nfibers', 'diameter', 'fiber_gap')
+"""Parameters that define the geometry of the fiber stack, see :func:`Setup.reconfigure`"""
+
+IMPACT_BINS = np.array([25.0, 50.0, 75.0, 100.0, 125.0])
+"""Upper edges (in um) of the impact parameter bins. Each bin has its own photon yield distribution."""
+
+
+def yield_function_1(x):
+    return 57.5095*np.exp(-0.5*((x-22.1398)/6.16924)**2)
+
+
+def yield_function_2(x):
+    return Sampling.landau(x, 18.4867, 2.66185)*341.192
+
+
+def yield_function_3(x):
+    return Sampling.landau(x, 17.9427, 2.74043)*364.594
+
+
+def yield_function_4(x):
+    return 68.0951*np.exp(-0.5*((x-18.178)/4.91197)**2)
+
+
+def yield_function_5(x):
+    return 59.8287*np.exp(-0.5*((x-12.1788)/4.54820)**2)
+
+
+PHOTON_YIELD_FUNCTIONS = [
+    ("57.5095*exp(-0.5*pow((x-22.1398)/6.16924,2))", 0, 50, yield_function_1),
+    ("TMath::Landau(x,18.4867,2.66185,0)*341.192", 0, 50, yield_function_2),
+    ("TMath::Landau(x,17.9427,2.74043,0)*364.594", 0, 50, yield_function_3),
+    ("68.0951*exp(-0.5*pow((x-18.178)/4.91197,2))", 0, 50, yield_function_4),
+    ("59.8287*exp(-0.5*pow((x-12.1788)/4.54820,2))", 0, 40, yield_function_5),
+]
+"""Photon yield distributions obtained by a Geant simulation, one for each bin of :data:`IMPACT_BINS`.
+
+   Each entry is (ROOT formula, xmin, xmax, numpy function): the ROOT formula and the numpy function
+   describe the same distribution."""
+
+
+def getImpactParameter(Xc, Yc, Theta, X0, Y0):
+    """Distance between the fiber axis in (Xc, Yc) and the track starting in (X0, Y0) with angle Theta.
+
+       The track direction is (sin(Theta), cos(Theta)), so the impact parameter is the modulus of the
+       component of the vector (Xc-X0, Yc-Y0) perpendicular to it. All the arguments can be numbers or numpy arrays."""
+    sin_theta = np.sin(Theta)
+    cos_theta = np.cos(Theta)
+    return np.abs((Xc-X0)*cos_theta - (Yc-Y0)*sin_theta)
+
+
+def getYieldBin(impact):
+    """Index in :data:`PHOTON_YIELD_FUNCTIONS` of the distribution to use for the impact parameter (in m).
+
+       The bins are closed on the right: an impact of exactly 25 um belongs to the first bin."""
+    bins = np.searchsorted(IMPACT_BINS, np.asarray(impact)*1000000, side='left')
+    return np.minimum(bins, len(IMPACT_BINS)-1)
+
+
+def getYieldSampler(ybin, backend='numpy'):
+    """Returns the :class:`Sampling.InverseCDFSampler` of the photon yield distribution of the bin ybin.
+
+       The sampler is tabulated only the first time it is requested in the process. With backend='numpy'
+       the table is built from the numpy function, with backend='root' from the ROOT formula."""
+    formula, xmin, xmax, function = PHOTON_YIELD_FUNCTIONS[ybin]
+    if backend == 'numpy':
+        factory = lambda: Sampling.InverseCDFSampler.fromFunction(function, xmin, xmax)
+    elif backend == 'root':
+        factory = lambda: Sampling.InverseCDFSampler.fromTF1(formula, xmin, xmax)
+    else:
+        raise ValueError("unknown sampler backend '%s'" % backend)
+    return Sampling.getSampler(('photon_yield', ybin, backend), factory)
+
+
+def samplePhotonYield(bins, rng=np.random, backend='numpy'):
+    """Returns an array with a random number of photons for each element of *bins*.
+
+       The numbers of photons of all the fibers in the same bin are drawn with one call of the sampler."""
+    bins = np.asarray(bins)
+    number = np.zeros(bins.shape, dtype=float)
+    for b in np.unique(bins):
+        selected = bins == b
+        number[selected] = getYieldSampler(b, backend).sample(np.count_nonzero(selected), rng)
+    return np.floor(number+0.5).astype(int)
 
 
 class Fiber(object):
@@ -17,18 +105,41 @@ class Fiber(object):
 
         Each object fiber is defined by the center coordinates (the attributes Xc and Yc), the
         diameter and the refraction index of the core material.
+        The attributes are not stored in the object itself: a fiber is a thin view on one element
+        of a :class:`FiberStack`, so reading or writing Xc, Yc, diameter, core_index or photons
+        reads or writes the corresponding element of the stack arrays.
+        A fiber created on its own (es: Fiber(Xc, Yc)) gets a private stack of one element.
         All the method of this class are definide here:
                
 
           """
-    def __init__(self, Xc=0, Yc=0, diameter=250e-06, core_index=1.59):
+    __slots__ = ('_stack', '_index')
+
+    def __init__(self, Xc=0, Yc=0, diameter=250e-06, core_index=CORE_INDEX, stack=None, index=None):
 
         """The init method is invoked to create a new class instance """ 
-        self.Xc = Xc
-        self.Yc = Yc
-        self.diameter = diameter
-        self.core_index = core_index
-        self.photons = 0
+        if stack is None:
+            stack = FiberStack(1, 1, diameter, core_index)
+            index = (0, 0)
+            stack.Xc[index] = Xc
+            stack.Yc[index] = Yc
+        self._stack = stack
+        self._index = index
+
+    def _stackAttribute(name):
+        """Build a property that reads and writes the element of this fiber in the stack array *name*"""
+        def getter(self):
+            return getattr(self._stack, name)[self._index]
+        def setter(self, value):
+            getattr(self._stack, name)[self._index] = value
+        return property(getter, setter)
+
+    Xc = _stackAttribute('Xc')
+    Yc = _stackAttribute('Yc')
+    diameter = _stackAttribute('diameter')
+    core_index = _stackAttribute('core_index')
+    photons = _stackAttribute('photons')
+    del _stackAttribute
      
     def getImpact(self, Theta, X0, Y0):
         """Method to calculate the impact parameter.
@@ -36,55 +147,213 @@ class Fiber(object):
            of the fiber center, returns the impact parameter of the particle  with respect
            to the fiber axis. This method is invoked by the method :func:`producePhotons`."""
      
-        Xp=X0 + math.sin(Theta)*math.sin(Theta)*(self.Xc-X0) + math.sin(Theta)*math.cos(Theta)*(self.Yc-Y0);
-        Yp=Y0 + math.sin(Theta)*math.cos(Theta)*(self.Xc-X0) + math.cos(Theta)*math.cos(Theta)*(self.Yc-Y0);
-        impact=math.sqrt((self.Xc-Xp)*(self.Xc-Xp)+(self.Yc-Yp)*(self.Yc-Yp))
-        #print 'imp', impact,'xp', Xp, 'yp', Yp, self.Xc, self.Yc
+        impact=getImpactParameter(self.Xc, self.Yc, Theta, X0, Y0)
         return impact
 
-    def producePhotons(self, Theta, X0, Y0):
+    def producePhotons(self, Theta, X0, Y0, rng=np.random):
         """Generation of photons.
            According to the value of the impact parameter, calculated calling the method :func:`getImpact`,
            a certain number of photons is generetad randomly following the shape of some functions. These functions
-           represent the photons distribution obtained by a Geant simulation.
+           represent the photons distribution obtained by a Geant simulation (see :data:`PHOTON_YIELD_FUNCTIONS`).
            This function returns a number of photons greater than zero only if the impact parameter is lower
            than tha radius of the fiber"""
 
         impact=self.getImpact(Theta, X0,Y0)
-        #print impact
-        #impact=0.000123
-        #print self.diameter
         if impact<=self.diameter/2:
-
-           # print impact
-            impact=impact*1000000
-            if impact>=0 and impact<=25:
-                f1=ROOT.TF1("f1","57.5095*exp(-0.5*pow((x-22.1398)/6.16924,2))",0,50)
-                number=f1.GetRandom()
-            elif impact>25 and impact<=50:
-                f1=ROOT.TF1("f1","TMath::Landau(x,18.4867,2.66185,0)*341.192",0,50)
-                number=f1.GetRandom()
-                
-            elif impact>50 and impact<=75:
-                f1=ROOT.TF1("f1","TMath::Landau(x,17.9427,2.74043,0)*364.594",0,50)
-                number=f1.GetRandom()
-                
-            elif impact>75 and impact<=100:
-                f1=ROOT.TF1("f1","68.0951*exp(-0.5*pow((x-18.178)/4.91197,2))",0,50)
-                number=f1.GetRandom()
-                
-            elif impact>100 and impact<=125:
-                f1=ROOT.TF1("f1","59.8287*exp(-0.5*pow((x-12.1788)/4.54820,2))",0,40)
-                number=f1.GetRandom()
-                
-             
-            self.photons=int(round(number))
+            self.photons=samplePhotonYield([getYieldBin(impact)], rng, self._stack.sampler_backend)[0]
         else:
             self.photons=0
 
-        #print self.photons
     def resetPhotons(self):
         self.photons=0
+
+
+class FiberStack(object):
+    """Structure of arrays describing a stack of fibers.
+
+        The fibers are organized in a matrix of layers x nfibers. Instead of storing one
+        :class:`Fiber` object for each element, every fiber attribute is stored in a contiguous
+        numpy array with shape (layers, nfibers): the float arrays Xc, Yc, diameter and core_index
+        and the int array photons.
+        Indexing the stack (es: stack[layer][fiber] or stack[layer, fiber]) returns a :class:`Fiber`
+        view on the selected element, so the code using the old matrix of fiber objects keeps working.
+        """
+
+    def __init__(self, layers, nfibers, diameter=250e-06, core_index=CORE_INDEX):
+
+        shape = (layers, nfibers)
+        self.Xc = np.zeros(shape, dtype=float)
+        self.Yc = np.zeros(shape, dtype=float)
+        self.diameter = np.full(shape, diameter, dtype=float)
+        self.core_index = np.full(shape, core_index, dtype=float)
+        self.photons = np.zeros(shape, dtype=int)
+        self.sampler_backend = 'numpy'
+        self.hit_fibers = np.zeros(0, dtype=int)
+        # flat indices (layer*nfibers+fiber) of the fibers hit in the last call of producePhotons
+        self.crosstalk_prob = 0.0
+        # probability of cross-talk between two neighbour fibers, see :func:`buildCrossTalk`
+        self.buildIndex()
+
+    @property
+    def shape(self):
+        return self.photons.shape
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return Fiber(stack=self, index=key)
+        return FiberLayer(self, key)
+
+    def __iter__(self):
+        for layer in range(len(self)):
+            yield FiberLayer(self, layer)
+
+    def getImpact(self, Theta, X0, Y0):
+        """Array (layers x nfibers) with the impact parameter of the particle for all the fibers of the stack"""
+        return getImpactParameter(self.Xc, self.Yc, Theta, X0, Y0)
+
+    def buildIndex(self):
+        """Build the per-layer index used by :func:`getCandidates`.
+
+           For each layer the fibers are sorted by Xc, and the extent in y and the largest radius of the layer are stored.
+           It has to be called again if the coordinates or the diameters of the fibers are changed."""
+        self.x_order = np.argsort(self.Xc, axis=1, kind='mergesort')
+        self.sorted_Xc = self.Xc[np.arange(len(self))[:, np.newaxis], self.x_order]
+        self.layer_ymin = self.Yc.min(axis=1) if self.Yc.size else np.zeros(len(self))
+        self.layer_ymax = self.Yc.max(axis=1) if self.Yc.size else np.zeros(len(self))
+        self.layer_radius = self.diameter.max(axis=1)/2 if self.diameter.size else np.zeros(len(self))
+
+    def getCandidates(self, Theta, X0, Y0):
+        """Range of the fibers that the track can hit in each layer.
+
+           A fiber in (Xc, Yc) is hit if its impact parameter |Xc-x(Yc)|*cos(Theta) is lower than its radius, where
+           x(Yc) = X0+(Yc-Y0)*tan(Theta) is the position of the track at the height of the fiber. So in each layer only the
+           fibers with Xc in a window of half width radius/cos(Theta) around the track can be hit, and the window is found
+           with a binary search in the x positions sorted by :func:`buildIndex`.
+           Theta, X0 and Y0 can be numbers or arrays of the same shape (one value per event). Returns the arrays (start, stop)
+           with shape (..., layers): the candidates of the layer l are the fibers x_order[l, start:stop]."""
+        Theta = np.asarray(Theta, dtype=float)[..., np.newaxis]
+        X0 = np.asarray(X0, dtype=float)[..., np.newaxis]
+        Y0 = np.asarray(Y0, dtype=float)[..., np.newaxis]
+        cos_theta = np.cos(Theta)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tan_theta = np.tan(Theta)
+            x_ymin = X0+(self.layer_ymin-Y0)*tan_theta
+            x_ymax = X0+(self.layer_ymax-Y0)*tan_theta
+            # the window is slightly enlarged so that no fiber on its border is lost for rounding errors
+            half_width = self.layer_radius/np.abs(cos_theta)*(1+1e-9)
+            low = np.minimum(x_ymin, x_ymax)-half_width
+            high = np.maximum(x_ymin, x_ymax)+half_width
+        along_layers = np.abs(cos_theta) < 1e-12
+        low = np.where(along_layers, -np.inf, low)
+        high = np.where(along_layers, np.inf, high)
+        start = np.empty(low.shape, dtype=int)
+        stop = np.empty(high.shape, dtype=int)
+        for layer in range(len(self)):
+            start[..., layer] = np.searchsorted(self.sorted_Xc[layer], low[..., layer], side='left')
+            stop[..., layer] = np.searchsorted(self.sorted_Xc[layer], high[..., layer], side='right')
+        return start, stop
+
+    def getCandidateIndices(self, Theta, X0, Y0):
+        """Flat indices (layer*nfibers+fiber) of the fibers that a track can hit, from :func:`getCandidates`"""
+        start, stop = self.getCandidates(Theta, X0, Y0)
+        nfibers = self.shape[1]
+        return np.concatenate([self.x_order[layer, start[layer]:stop[layer]]+layer*nfibers for layer in range(len(self))] +
+                              [np.zeros(0, dtype=int)])
+
+    def expandCandidates(self, start, stop):
+        """Turns the candidate ranges (start, stop) of a block of events, given by :func:`getCandidates` with shape
+           (events, layers), into the flat list of (event, fiber) pairs. Returns the arrays (event, fiber), where
+           fiber is the flat index (layer*nfibers+fiber) of the candidate fiber."""
+        nevents, layers = start.shape
+        counts = (stop-start).ravel()
+        total = counts.sum()
+        event = np.repeat(np.arange(nevents), counts.reshape(nevents, layers).sum(axis=1))
+        layer = np.repeat(np.tile(np.arange(layers), nevents), counts)
+        # position of each candidate in the sorted x of its layer: start of its range plus its rank in the range
+        first = np.cumsum(counts)-counts
+        position = np.arange(total)-np.repeat(first, counts)+np.repeat(start.ravel(), counts)
+        return event, layer*self.shape[1]+self.x_order[layer, position]
+
+    def buildCrossTalk(self, probability, distance):
+        """Build the sparse coupling matrix of the optical cross-talk between the fibers.
+
+           Two fibers are neighbours if the distance between their centers is at most distance, and each photon of a fiber
+           produces a photon in each of its neighbours with the given probability. The neighbours are found with the same
+           binary search in the sorted x of each layer used by :func:`getCandidates`, with every fiber taking the place of a track,
+           so the construction does not compare all the pairs of fibers. The matrix is stored in compressed rows: the neighbours
+           of the fiber i (flat index) are crosstalk_neighbours[crosstalk_start[i]:crosstalk_start[i+1]]."""
+        x = self.Xc.ravel()
+        start = np.empty((len(x), len(self)), dtype=int)
+        stop = np.empty((len(x), len(self)), dtype=int)
+        for layer in range(len(self)):
+            start[:, layer] = np.searchsorted(self.sorted_Xc[layer], x-distance, side='left')
+            stop[:, layer] = np.searchsorted(self.sorted_Xc[layer], x+distance, side='right')
+        source, target = self.expandCandidates(start, stop)
+        # the positions are accumulated fiber after fiber, so the distance is compared with a small tolerance
+        near = np.hypot(self.Xc.flat[target]-self.Xc.flat[source], self.Yc.flat[target]-self.Yc.flat[source]) <= distance*(1+1e-9)
+        neighbours = near & (source != target)
+        self.crosstalk_start = np.concatenate(([0], np.cumsum(np.bincount(source[neighbours], minlength=len(x)))))
+        self.crosstalk_neighbours = target[neighbours]
+        self.crosstalk_prob = probability
+
+    def getCrossTalk(self, fibers, photons, rng=np.random):
+        """Photons produced by cross-talk by the fibers (flat indices) with the given photons, see :func:`buildCrossTalk`.
+
+           The number of photons that each fiber gives to each neighbour is drawn from a binomial distribution, for all the
+           (fiber, neighbour) pairs at once. Returns the arrays (source, fiber, photons) of the pairs with at least one photon:
+           source is the index in the input arrays of the fiber that produced them, fiber the flat index of the neighbour."""
+        fibers = np.asarray(fibers, dtype=int)
+        if self.crosstalk_prob <= 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        counts = self.crosstalk_start[fibers+1]-self.crosstalk_start[fibers]
+        source = np.repeat(np.arange(len(fibers)), counts)
+        edge = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)+np.repeat(self.crosstalk_start[fibers], counts)
+        leaked = rng.binomial(np.repeat(np.asarray(photons, dtype=int), counts), self.crosstalk_prob)
+        kept = leaked > 0
+        return source[kept], self.crosstalk_neighbours[edge[kept]], leaked[kept]
+
+    def producePhotons(self, Theta, X0, Y0, rng=np.random):
+        """Generation of photons in all the fibers of the stack.
+
+           It does for the whole stack what :func:`Fiber.producePhotons` does for a single fiber, but only the fibers
+           that the track can hit, given by :func:`getCandidateIndices`, are considered: their impact parameters are
+           computed with one array operation, the fibers with an impact parameter lower than the radius are selected
+           and their numbers of photons are sampled together, bin by bin. The flat indices of these fibers are stored
+           in the attribute hit_fibers.
+           Returns the array of photons, that is also stored in the attribute photons."""
+        candidates = self.getCandidateIndices(Theta, X0, Y0)
+        impact = getImpactParameter(self.Xc.flat[candidates], self.Yc.flat[candidates], Theta, X0, Y0)
+        hit = impact <= self.diameter.flat[candidates]/2
+        self.photons.fill(0)
+        self.hit_fibers = candidates[hit]
+        self.photons.flat[self.hit_fibers] = samplePhotonYield(getYieldBin(impact[hit]), rng, self.sampler_backend)
+        return self.photons
+
+    def resetPhotons(self):
+        """Set to zero the number of photons of all the fibers of the stack"""
+        self.photons.fill(0)
+
+
+class FiberLayer(object):
+    """Row of a :class:`FiberStack`: indexing a layer returns a :class:`Fiber` view"""
+    __slots__ = ('stack', 'layer')
+
+    def __init__(self, stack, layer):
+        self.stack = stack
+        self.layer = layer
+
+    def __len__(self):
+        return self.stack.shape[1]
+
+    def __getitem__(self, nfiber):
+        return Fiber(stack=self.stack, index=(self.layer, nfiber))
+
+    def __iter__(self):
+        for nfiber in range(len(self)):
+            yield self[nfiber]
          
 
 
@@ -95,7 +364,7 @@ class Setup(object):
         close fiber in the same layer,usint the class method __init__ a class instance is created
         with these caracheteristics.
         The most important attribute of this class is :attr:`fiber_stack` that representes one matrix of
-        fiber objects. For each fiber, a position for the center is assigned in order to define the geometry
+        fibers, stored as a :class:`FiberStack`. For each fiber, a position for the center is assigned in order to define the geometry
         of the simulated setup.
            
            
@@ -103,9 +372,13 @@ class Setup(object):
     
    
     #def __init__(self, filename, layers=5, nfibers=128, diameter=250e-06, gap_diam=30e-06, ch_widht=0.25e-03, ch_height=1.5e-03):
-    def __init__(self, parameter):
+    def __init__(self, parameter, rng=np.random, instrumentation=Instrumentation.NULL):
         #self.param=MainSimulation.Parameters(filename) 
         self.param = parameter
+        self.rng = rng
+        self.instrumentation = instrumentation
+        self.statistics = Statistics.NULL
+        # statistics of the hit fibers, see :func:`setStatistics`
         self.layers = self.param.layers
         #self.nfibers = nfibers
         #self.diameter = diameter
@@ -117,70 +390,167 @@ class Setup(object):
         self.gap = self.param.fiber_gap
         self.channel_width = self.param.ch_width
         self.channel_height = self.param.ch_height
-        self.channel_array = Sipm.ChannelArray(parameter)
-        self.x = -random.random()*self.diameter/2
+        self.channel_array = Sipm.ChannelArray(parameter, rng, instrumentation)
+        self.x = -self.rng.uniform()*self.diameter/2
         self.y = math.sqrt(math.pow(self.diameter,2) - math.pow((self.diameter+self.gap)/2,2))
         self.y0 = self.diameter/2*math.cos(math.asin((self.diameter+self.gap)/2/self.diameter))
          
-        self.fiber_stack = []
-        """Matrix of fiber objects.
+        self.fiber_stack = FiberStack(self.layers, self.nfibers, self.diameter, CORE_INDEX)
+        """Stack of fibers, an object of the class :class:`FiberStack`.
 
         This matrix represent a stack of fibers, our setup. For each fiber, a position for the center is assigned in order to define the geometry
         of the simulated setup.   """
+        self.fiber_stack.sampler_backend = getattr(self.param, 'sampler_backend', 'numpy')
 
-        pro=[]
-        x= self.x
-        for i in range (self.nfibers): 
-            temp = []               
-            
-            for j in range (self.layers):
-                if j%2==0:
-                    temp.append(Fiber(x, 2.0*(j-1.0)*self.y-j*self.y,self.diameter,1.59 ))
-                else:
-                    temp.append(Fiber(x+(self.diameter+self.gap),(-2.0+j)*self.y,self.diameter,1.59))
-               
-            x+= self.diameter+self.gap
-            pro.append(temp)
-        a=np.array(pro).T    #the list of list "pro" is transformed in a numpy array because we need to transpose it.
-        self.fiber_stack=a
+        pitch = self.diameter+self.gap
+        # x is accumulated fiber after fiber, as done when the stack was built one Fiber at a time
+        x = np.cumsum(np.concatenate(([self.x], np.full(self.nfibers-1, pitch))))
+        for j in range (self.layers):
+            if j%2==0:
+                self.fiber_stack.Xc[j] = x
+                self.fiber_stack.Yc[j] = 2.0*(j-1.0)*self.y-j*self.y
+            else:
+                self.fiber_stack.Xc[j] = x+pitch
+                self.fiber_stack.Yc[j] = (-2.0+j)*self.y
+        self.fiber_stack.buildIndex()
+        self.setCrossTalk()
        
+    def setCrossTalk(self):
+        """Build the cross-talk matrix of the stack if the parameter crosstalk_prob is greater than zero. The neighbours are the
+        fibers with the centers closer than crosstalk_distance, by default the distance of two fibers in the same layer."""
+        probability = getattr(self.param, 'crosstalk_prob', 0.0)
+        if probability > 0:
+            distance = getattr(self.param, 'crosstalk_distance', None) or (self.diameter+self.gap)
+            self.fiber_stack.buildCrossTalk(probability, distance)
+        else:
+            self.fiber_stack.crosstalk_prob = 0.0
+
     def simulateParticle(self, Theta, X0,Y0):
         """This method simulates the particle passing through the stack of fibers.
 
-        For each fiber in the stack, the :func:`producePhotons` in the class :class:`Fiber` is called.
+        The photons are produced in all the fibers of the stack at once by :func:`FiberStack.producePhotons`.
         After the photons production,in oder to simulate the signal produced by photons in the detector
-        the functions :func:`Sipm.ChannelArray.fillPixels`, :func:`Sipm.ChannelArray.fillChannelArray`, from :mod:`Sipm`, class :class:`Sipm.ChannelArray`
+        the functions :func:`Sipm.ChannelArray.fillStackPixels`, :func:`Sipm.ChannelArray.fillChannelArray`, from :mod:`Sipm`, class :class:`Sipm.ChannelArray`
         are invoked."""
-        print self.nfibers
-        for layers in range(self.layers):
-            
-            for nfibers in range(self.nfibers):
-            #for layers in range(self.layers):
-                self.fiber_stack[layers][nfibers].producePhotons(Theta,X0,Y0)
-                if self.fiber_stack[layers][nfibers].photons>0:
-                    
-                    print layers, nfibers, self.fiber_stack[layers][nfibers].Yc
-                    print self.fiber_stack[layers][nfibers].photons
-         
-        for nfibers in range(self.nfibers):
-            for layers in range(self.layers):
-                 
-                self.channel_array.fillPixels(self.fiber_stack[layers][nfibers])
+        instrumentation = self.instrumentation
+        with instrumentation.stage('yield_sampling'):
+            photons = self.fiber_stack.producePhotons(Theta, X0, Y0, self.rng)
+        hit_fibers = self.fiber_stack.hit_fibers
+        instrumentation.count('hit_fibers', len(hit_fibers))
+        instrumentation.count('photons', photons.flat[hit_fibers].sum())
+        if self.statistics.enabled:
+            impact = getImpactParameter(self.fiber_stack.Xc.flat[hit_fibers], self.fiber_stack.Yc.flat[hit_fibers], Theta, X0, Y0)
+            self.statistics.fillFibers(getYieldBin(impact), photons.flat[hit_fibers])
+        if self.fiber_stack.crosstalk_prob > 0:
+            with instrumentation.stage('crosstalk'):
+                self.checkFiberCrossTalk()
+
+        with instrumentation.stage('photon_transport'):
+            self.channel_array.fillStackPixels(self.fiber_stack)
+        with instrumentation.stage('digitization'):
+            self.channel_array.fillChannelArray()
+        instrumentation.count('fired_pixels', self.channel_array.pixel_lit_per_channel.sum())
+
+    def simulateBlock(self, Theta, X0, Y0=0, rng=None):
+        """This method simulates a block of events, one particle for each element of the arrays Theta and X0.
+
+        All the events are simulated together: the candidate fibers of all the tracks (:func:`FiberStack.getCandidates`) are
+        expanded in a list of (event, fiber) pairs, the impact parameters and the photons of the hit fibers are computed with
+        one array operation, the photons of the whole block are transported by :func:`Sipm.ChannelArray.transportPhotons`
+        (see :func:`transportBlock`) and the fired pixels are counted per event and channel by :func:`digitizeBlock`.
+        The fiber_stack photons and the channel_array pixels are not used, so no reset is needed between blocks.
+        The random numbers are drawn from rng, by default the random generator of the setup.
+        Returns the matrix (events x channel_number) with the number of pixels fired per channel."""
+        return self.digitizeBlock(*self.transportBlock(Theta, X0, Y0, rng))
+
+    def transportBlock(self, Theta, X0, Y0=0, rng=None):
+        """First part of :func:`simulateBlock`: production of the photons in the fibers and transport to the SiPM.
+
+        Returns (event, x_pixel, y_pixel, nevents), with the event and the pixel of each detected photon, to give to :func:`digitizeBlock`.
+        It uses only rng and no state of the setup, so blocks with different generators can be transported at the same time."""
+        rng = self.rng if rng is None else rng
+        Theta = np.asarray(Theta, dtype=float)
+        X0 = np.asarray(X0, dtype=float)
+        Y0 = np.broadcast_to(np.asarray(Y0, dtype=float), Theta.shape)
+        stack = self.fiber_stack
+        instrumentation = self.instrumentation
+        with instrumentation.stage('yield_sampling'):
+            event, fiber = stack.expandCandidates(*stack.getCandidates(Theta, X0, Y0))
+            impact = getImpactParameter(stack.Xc.flat[fiber], stack.Yc.flat[fiber], Theta[event], X0[event], Y0[event])
+            hit = impact <= stack.diameter.flat[fiber]/2
+            event, fiber = event[hit], fiber[hit]
+            ybins = getYieldBin(impact[hit])
+            photons = samplePhotonYield(ybins, rng, stack.sampler_backend)
+        self.statistics.fillFibers(ybins, photons)
+        instrumentation.count('hit_fibers', len(fiber))
+        instrumentation.count('photons', photons.sum())
+        if stack.crosstalk_prob > 0:
+            with instrumentation.stage('crosstalk'):
+                source, neighbour, leaked = stack.getCrossTalk(fiber, photons, rng)
+                event, fiber, photons = [np.concatenate(a) for a in ((event, event[source]), (fiber, neighbour), (photons, leaked))]
+            instrumentation.count('crosstalk_photons', leaked.sum())
+        with instrumentation.stage('photon_transport'):
+            x_pixel, y_pixel, source = self.channel_array.transportPhotons(stack.Xc.flat[fiber], stack.Yc.flat[fiber], stack.diameter.flat[fiber],
+                                                                           stack.core_index.flat[fiber], photons, rng, return_source=True)
+        return event[source], x_pixel, y_pixel, len(Theta)
 
-        self.channel_array.fillChannelArray()
+    def digitizeBlock(self, event, x_pixel, y_pixel, nevents):
+        """Second part of :func:`simulateBlock`: returns the matrix (nevents x channel_number) of the pixels fired per channel"""
+        with self.instrumentation.stage('digitization'):
+            response = self.channel_array.countFiredPixels(event, x_pixel, y_pixel, nevents)
+        self.instrumentation.count('fired_pixels', response.sum())
+        return response
 
     def reset(self):
 
-        self.channel_array.resetArray()
-        for nfibers in range(self.nfibers):
-            for layers in range(self.layers):
-                self.fiber_stack[layers][nfibers].resetPhotons()
+        with self.instrumentation.stage('reset'):
+            self.channel_array.resetArray()
+            self.fiber_stack.resetPhotons()
         
                  
      
+    def setRandomState(self, rng):
+        """Use rng (numpy.random or a numpy.random.RandomState) for all the random numbers of the following events"""
+        self.rng = rng
+        self.channel_array.rng = rng
+
+    def setStatistics(self, statistics):
+        """Give the photons of the hit fibers of the following events to statistics (a :class:`Statistics.RunStatistics`)"""
+        self.statistics = statistics
+
+    def reconfigure(self, parameter, rng=np.random, instrumentation=Instrumentation.NULL):
+        """Use the setup with a new set of parameters, keeping the fiber stack.
+
+        Only the channel array is built again, so the parameters of the Sipm and of the event can change, but not
+        the ones that define the geometry (:data:`GEOMETRY_PARAMETERS`): in that case a ValueError is raised."""
+        for name in GEOMETRY_PARAMETERS:
+            if getattr(parameter, name) != getattr(self.param, name):
+                raise ValueError("the parameter %s changes the geometry, a new Setup is needed" % name)
+        self.param = parameter
+        self.rng = rng
+        self.instrumentation = instrumentation
+        self.channel_width = self.param.ch_width
+        self.channel_height = self.param.ch_height
+        self.channel_array = Sipm.ChannelArray(parameter, rng, instrumentation)
+        self.fiber_stack.sampler_backend = getattr(self.param, 'sampler_backend', 'numpy')
+        self.setCrossTalk()
+
+    def setInstrumentation(self, instrumentation):
+        """Record the times and the counters of the following events in instrumentation (see :mod:`Instrumentation`)"""
+        self.instrumentation = instrumentation
+        self.channel_array.instrumentation = instrumentation
+
     def checkFiberCrossTalk(self):
-         
-        pass
+        """Adds to the fibers of the stack the photons produced by cross-talk by the fibers hit in the event (see :func:`FiberStack.getCrossTalk`).
+
+        The photons are added to the neighbours, that become part of the hit_fibers of the stack, without removing them from
+        the fibers that produced them. Only the photons produced by the particle give cross-talk."""
+        stack = self.fiber_stack
+        hit = stack.hit_fibers
+        source, neighbour, leaked = stack.getCrossTalk(hit, stack.photons.flat[hit], self.rng)
+        np.add.at(stack.photons.reshape(-1), neighbour, leaked)
+        stack.hit_fibers = np.union1d(hit, neighbour)
+        self.instrumentation.count('crosstalk_photons', leaked.sum())
 
     def getObjectChannel(self):
         """This method retuns an object from :mod:`Sipm`, class :class:`ChannelArray`, used to get
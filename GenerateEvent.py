@@ -6,42 +6,122 @@
    :synopsis: Simulation of the event
 .. moduleauthor:: Sebastiana Giani <sebastiana.giani@epfl.ch>
 """
+import copy
 import numpy as np
 import math
-import random
-import ROOT
+import multiprocessing
 import FiberSetup
 import Sipm
+import OutputWriter
+import Checkpoint
+import RandomService
+import Statistics
+import Pipeline
+import FastSimulation
+import Instrumentation
 
 
 
 
 class Event:
-    """The class Event is the most important class of the simulation. In this class, using the method :func:`writeDataRoot``,
+    """The class Event is the most important class of the simulation. In this class, using the method :func:`writeData``,
     inside a loop that defines the number of events to generate in the simulation, the function :func"`generateSignalEvent` is invoked.
     ."""
 
     #def __init__(self, theta_max, spare_channel, method, nEvents, parameter):
-    def __init__(self,parameter):
+    def __init__(self,parameter, rng=None, setup=None):
         self.param=parameter
         self.theta_max=self.param.theta_max
         self.spare_channel=self.param.spare_channel 
         self.method=self.param.method
-        self.setup=FiberSetup.Setup(parameter)
+        self.seed=getattr(self.param, 'seed', None)
+        self.nworkers=getattr(self.param, 'nworkers', 1)
+        self.block_size=getattr(self.param, 'block_size', 0)
+        self.random=RandomService.RandomService(self.seed, getattr(self.param, 'random_buffer_size', 4096))
+        # random streams of the run, see :mod:`RandomService`
+        self.substreams=rng is None
+        # True if the events take their random numbers from the streams of self.random, False if from self.rng
+        if rng is None:
+            rng=self.random.geometry()
+        self.rng=rng
+        self.instrumentation=Instrumentation.create(getattr(self.param, 'instrumentation', False))
+        if setup is None:
+            setup=FiberSetup.Setup(parameter, rng, self.instrumentation)
+        else:
+            setup.reconfigure(parameter, rng, self.instrumentation)
+        self.setup=setup
+        # an existing setup can be given to reuse its fiber stack, see :func:`FiberSetup.Setup.reconfigure`
+        self.multiplicity=getattr(self.param, 'multiplicity', 1)
+        self.multiplicity_mode=getattr(self.param, 'multiplicity_mode', 'fixed')
+        if self.multiplicity_mode=='fixed':
+            if self.multiplicity<1 or self.multiplicity!=int(self.multiplicity):
+                raise ValueError("the fixed multiplicity must be a positive integer, not %s" % self.multiplicity)
+            self.max_tracks=int(self.multiplicity)
+        elif self.multiplicity_mode=='poisson':
+            self.max_tracks=getattr(self.param, 'max_multiplicity', 0) or int(math.ceil(self.multiplicity+5*math.sqrt(self.multiplicity)))+1
+        else:
+            raise ValueError("unknown multiplicity mode '%s'" % self.multiplicity_mode)
+        self.pileup=self.max_tracks>1 or self.multiplicity_mode=='poisson'
+        # with pile-up the events have several tracks, simulated together in blocks (see :func:`generatePileupBlock`)
+        if self.pileup:
+            self.block_size=self.block_size or 1000
+        self.templates=None
+        # templates of the fast simulation, see :mod:`FastSimulation`
+        if getattr(self.param, 'simulation', 'full')=='fast':
+            if self.pileup:
+                raise ValueError("the fast simulation does not support the pile-up, it needs the multiplicity 1")
+            self.templates=FastSimulation.getTemplates(self.param, self.setup, self.random.seed)
+            self.block_size=self.block_size or 1000
+        self.statistics=self.createStatistics() if getattr(self.param, 'statistics', False) else Statistics.NULL
+        self.setup.setStatistics(self.statistics)
         self.therarray=[]
         self.events=self.param.nevents
+
+    def createStatistics(self):
+        """Returns empty :class:`Statistics.RunStatistics` for the detector of the simulation, with statistics_theta_bins bins of theta
+        and a bin of the pixels fired per event for each number up to statistics_max_pixels (at most the pixels of the detector)"""
+        channel_array=self.setup.getObjectChannel()
+        npixels=channel_array.channel_number*channel_array.pixel_x_size*channel_array.pixel_y_size
+        return Statistics.RunStatistics(channel_array.channel_number, min(npixels, getattr(self.param, 'statistics_max_pixels', 1000)),
+                                        self.theta_max*math.pi/180.0, len(FiberSetup.IMPACT_BINS), getattr(self.param, 'statistics_theta_bins', 20))
+
+    def resetAccumulators(self):
+        """Starts new instrumentation and statistics, so they count only the events generated after the call"""
+        self.instrumentation=Instrumentation.create(self.instrumentation.enabled)
+        self.setup.setInstrumentation(self.instrumentation)
+        self.statistics=self.createStatistics() if self.statistics.enabled else Statistics.NULL
+        self.setup.setStatistics(self.statistics)
+
+    def setRandomState(self, rng):
+        """Use rng (numpy.random or a numpy.random.RandomState) for all the random numbers of the following events,
+        instead of the streams of :attr:`random`"""
+        self.substreams=False
+        self.useRandomState(rng)
+
+    def useRandomState(self, rng):
+        self.rng=rng
+        self.setup.setRandomState(rng)
+
+    def startEvents(self, first_event):
+        """Called before the generation of a group of events that starts from the event first_event: the events take
+        their random numbers from the stream of :attr:`random` of that event, so they do not depend on the events
+        generated before them"""
+        if self.substreams:
+            self.useRandomState(self.random.events(first_event))
         
-    def generateTheta(self):
-        """This method generates randomly the theta angle for the particle """
+    def generateTheta(self, size=None, rng=None):
+        """This method generates randomly the theta angle for the particle, or an array of size angles """
+        rng=self.rng if rng is None else rng
         if self.method==0:
-            theta=random.random()*(self.theta_max)*math.pi/180.0
-            self.therarray.append(theta)
+            theta=rng.uniform(size=size)*(self.theta_max)*math.pi/180.0
+            if size is None:
+                self.therarray.append(theta)
         return theta
 
-    def generateSignalPosition(self):
-        """ This function generates a random position for the particle"""
-        
-        X0=random.random()*((self.setup.getObjectChannel().channel_number-2*self.spare_channel)*(self.setup.getObjectChannel().channel_width)+self.spare_channel*(self.setup.getObjectChannel().channel_width))
+    def generateSignalPosition(self, size=None, rng=None):
+        """ This function generates a random position for the particle, or an array of size positions"""
+        rng=self.rng if rng is None else rng
+        X0=rng.uniform(size=size)*((self.setup.getObjectChannel().channel_number-2*self.spare_channel)*(self.setup.getObjectChannel().channel_width)+self.spare_channel*(self.setup.getObjectChannel().channel_width))
         #print self.setup.getObjectChannel().channel_width
         #print self.setup.getObjectChannel().channel_number 
         return X0    
@@ -55,53 +135,335 @@ class Event:
 
             """
         
-        theta=self.generateTheta()
-        self.therarray.append(theta)
-        X0=self.generateSignalPosition()
-        #print theta, X0
+        with self.instrumentation.stage('track_generation'):
+            theta=self.generateTheta()
+            X0=self.generateSignalPosition()
+        self.instrumentation.count('events')
         self.setup.simulateParticle(theta,X0,Y0=0)
-        
-        
+        return theta, X0
 
-    def writeDataRoot(self):
+    def runEvents(self, nevents, first_event=0):
+        """Generates nevents events calling :func:`generateSignalEvent` and resetting the setup after each one.
+
+        It is a generator: for each event it yields the arrays (of length one) theta and X0 with the angle and the position
+        of the particle and the matrix (1 x channel_number) with the pixels fired per channel. Each event has its own
+        random stream, given by first_event plus its number (see :func:`startEvents`)."""
+        for event in range (nevents):
+            self.startEvents(first_event+event)
+            theta, X0=self.generateSignalEvent()
+            response=self.setup.getObjectChannel().pixel_lit_per_channel[np.newaxis].copy()
+            self.setup.reset()
+            self.statistics.update([theta], [X0], response)
+            yield np.array([theta]), np.array([X0]), response
+
+    def generateSignalBlock(self, nevents):
+        """This method generates a block of nevents events at once.
+
+            The theta angles and the X0 positions of all the particles are drawn together, then the block is simulated
+            by :func:`FiberSetup.Setup.simulateBlock`, or by the templates of :mod:`FastSimulation` if the parameter simulation
+            is 'fast'. Returns the arrays theta and X0 and the matrix (nevents x channel_number) of the pixels fired per channel.
+            With pile-up the block is generated by :func:`generatePileupBlock`.
+
+            """
+        if self.pileup:
+            return self.generatePileupBlock(nevents)
+        with self.instrumentation.stage('track_generation'):
+            theta=self.generateTheta(nevents)
+            X0=self.generateSignalPosition(nevents)
+        self.instrumentation.count('events', nevents)
+        if self.templates is not None:
+            with self.instrumentation.stage('fast_simulation'):
+                return theta, X0, self.templates.simulateBlock(theta, X0, self.setup.getObjectChannel().channel_number, self.rng)
+        return theta, X0, self.setup.simulateBlock(theta, X0, Y0=0)
+
+    def generateMultiplicity(self, nevents, rng=None):
+        """Number of tracks of nevents events: the parameter multiplicity, or a Poisson number of mean multiplicity
+        if multiplicity_mode is 'poisson'. The Poisson numbers are limited to max_tracks, the tracks stored per event."""
+        rng=self.rng if rng is None else rng
+        if self.multiplicity_mode=='poisson':
+            return np.minimum(rng.poisson(self.multiplicity, nevents), self.max_tracks)
+        return np.full(nevents, self.max_tracks, dtype=int)
+
+    def generateTracks(self, nevents, rng=None):
+        """Generates the tracks of nevents events with pile-up. Returns the arrays theta and X0 of all the tracks, the
+        array with the event of each track and the number of tracks of each event."""
+        ntracks=self.generateMultiplicity(nevents, rng)
+        event=np.repeat(np.arange(nevents), ntracks)
+        theta=self.generateTheta(len(event), rng)
+        X0=self.generateSignalPosition(len(event), rng)
+        return theta, X0, event, ntracks
+
+    def generatePileupBlock(self, nevents):
+        """Generates a block of nevents events with several tracks each (pile-up).
+
+            The tracks of all the events are drawn by :func:`generateTracks` and transported together, as one block, by
+            :func:`FiberSetup.Setup.transportBlock`. Then the photons are given the event of their track and digitized by
+            :func:`FiberSetup.Setup.digitizeBlock`, so a pixel fired by two tracks of the same event is counted once. Returns
+            the columns of :func:`pileupColumns`."""
+        with self.instrumentation.stage('track_generation'):
+            theta, X0, event, ntracks=self.generateTracks(nevents)
+        self.instrumentation.count('events', nevents)
+        self.instrumentation.count('tracks', len(theta))
+        track, x_pixel, y_pixel, ntotal=self.setup.transportBlock(theta, X0, 0)
+        response=self.setup.digitizeBlock(event[track], x_pixel, y_pixel, nevents)
+        return self.pileupColumns(theta, X0, event, ntracks, response)
+
+    def pileupColumns(self, theta, X0, event, ntracks, response):
+        """Columns of a block of events with pile-up (see :func:`columns`): theta and X0 of the first track of each event
+        (nan for an event without tracks), the pixels fired per channel, the number of tracks and the matrices
+        (events x max_tracks) track_theta and track_X0 with the tracks of each event, padded with nan."""
+        nevents=len(ntracks)
+        slot=np.arange(len(event))-(np.cumsum(ntracks)-ntracks)[event]
+        track_theta=np.full((nevents, self.max_tracks), np.nan)
+        track_X0=np.full((nevents, self.max_tracks), np.nan)
+        track_theta[event, slot]=theta
+        track_X0[event, slot]=X0
+        return track_theta[:, 0].copy(), track_X0[:, 0].copy(), response, ntracks.astype(np.int32), track_theta, track_X0
+
+    def columns(self):
+        """Columns of the events of the run, see :func:`OutputWriter.eventColumns`"""
+        return OutputWriter.eventColumns(self.setup.getObjectChannel().channel_number, self.max_tracks if self.pileup else 0)
+
+    def runBlocks(self, nevents, first_event=0):
+        """Generates nevents events in blocks of block_size events calling :func:`generateSignalBlock`.
+
+        The block size bounds the memory used by the arrays of a block. It is a generator that yields the result
+        (theta, X0, pixels fired per channel) of each block. Each block has its own random stream, given by the
+        index of its first event counting from first_event (see :func:`startEvents`)."""
+        for first in range(0, nevents, self.block_size):
+            self.startEvents(first_event+first)
+            block=self.generateSignalBlock(min(self.block_size, nevents-first))
+            self.statistics.update(*block[:3])
+            yield block
+
+    def runPipelined(self, nevents, first_event=0):
+        """Generates nevents events in blocks, as :func:`runBlocks`, with the stages in a :class:`Pipeline.Pipeline`.
+
+        The track generation (:func:`generateTheta` and :func:`generateSignalPosition`), the production and transport of
+        the photons (:func:`FiberSetup.Setup.transportBlock`) and the digitization (:func:`FiberSetup.Setup.digitizeBlock`) of
+        different blocks run at the same time in three threads, while the caller writes the results. The queues between the
+        stages hold pipeline_queue_size blocks. Each block uses its own random stream, so the events are the same of :func:`runBlocks`."""
+        setup=self.setup
+        def tracks(block):
+            first, n=block
+            rng=self.random.events(first)
+            with self.instrumentation.stage('track_generation'):
+                if self.pileup:
+                    theta, X0, event, ntracks=self.generateTracks(n, rng)
+                else:
+                    theta=self.generateTheta(n, rng)
+                    X0=self.generateSignalPosition(n, rng)
+                    event, ntracks=None, None
+            self.instrumentation.count('events', n)
+            return theta, X0, event, ntracks, rng
+        def transport(block):
+            theta, X0, event, ntracks, rng=block
+            return theta, X0, event, ntracks, setup.transportBlock(theta, X0, 0, rng)
+        def digitize(block):
+            theta, X0, event, ntracks, photons=block
+            if event is None:
+                return theta, X0, setup.digitizeBlock(*photons)
+            track, x_pixel, y_pixel, ntotal=photons
+            return self.pileupColumns(theta, X0, event, ntracks, setup.digitizeBlock(event[track], x_pixel, y_pixel, len(ntracks)))
+        blocks=[(first_event+first, min(self.block_size, nevents-first)) for first in range(0, nevents, self.block_size)]
+        pipeline=Pipeline.Pipeline(blocks, [tracks, transport, digitize], getattr(self.param, 'pipeline_queue_size', 4))
+        for block in pipeline:
+            self.statistics.update(*block[:3])
+            yield block
+
+    def iterEvents(self, nevents, first_event=0):
+        """Generates nevents events, starting from the event first_event of the run, with :func:`runBlocks` if the
+        parameter block_size is greater than zero, otherwise one by one with :func:`runEvents`. Yields the results
+        (theta, X0, pixels fired per channel).
+
+        For a given seed and block_size, the events of a run are the same whatever the ranges in which they are
+        generated, as long as the ranges start at a multiple of block_size. If the parameter pipeline is True, the blocks
+        are generated by :func:`runPipelined`, except in the fast simulation."""
+        if self.block_size>0 and self.substreams and self.templates is None and getattr(self.param, 'pipeline', False):
+            return self.runPipelined(nevents, first_event)
+        if self.block_size>0:
+            return self.runBlocks(nevents, first_event)
+        return self.runEvents(nevents, first_event)
+
+    def run(self, nevents, first_event=0):
+        """Generates nevents events with :func:`iterEvents` and returns the arrays theta, X0 and the matrix
+        (nevents x channel_number) of the pixels fired per channel of all the events"""
+        blocks=list(self.iterEvents(nevents, first_event))
+        if not blocks:
+            return tuple(np.zeros((0,)+shape, dtype=dtype) for name, dtype, shape in self.columns())
+        return tuple(np.concatenate(column) for column in zip(*blocks))
+
+    def runParallel(self, nworkers):
+        """Generates the events of the simulation in nworkers processes.
+
+        The events are split in nworkers consecutive ranges, one for each process of a pool, and generated by :func:`iterParallel`.
+        The results are merged in event order, and they are the same of a run in one process."""
+        chunk_size=-(-self.events//nworkers) if self.events else 1
+        return tuple(np.concatenate(column) for column in zip(*self.iterParallel(nworkers, chunk_size)))
+
+    def iterParallel(self, nworkers, chunk_size, first_event=0):
+        """Generates the events of the simulation from first_event in chunks of about chunk_size events, in a pool of nworkers processes.
+
+        Every worker builds its own Event, with its :class:`FiberSetup.Setup`, once when the process starts (see :func:`_initWorker`),
+        and generates the events of each chunk with :func:`run`, with the random streams of the seed of the run (see :mod:`RandomService`),
+        so all the workers have the same geometry and the events are the same of a run in one process. chunk_size is rounded up to a multiple of block_size, as required by :func:`iterEvents`.
+        It is a generator that yields the result (theta, X0, pixels fired per channel) of each chunk in event order.
+        If it stops before the end, the processes are terminated without simulating the chunks left."""
+        if self.block_size>0:
+            chunk_size=-(-chunk_size//self.block_size)*self.block_size
+        chunks=[(first, min(chunk_size, self.events-first)) for first in range(first_event, self.events, chunk_size)]
+        pool=multiprocessing.Pool(nworkers, _initWorker, (self.param, self.random.seed))
+        try:
+            for result, instrumentation, statistics in pool.imap(_runWorker, chunks):
+                self.instrumentation.merge(instrumentation)
+                self.statistics.merge(statistics)
+                yield result
+        except BaseException:
+            # a worker or the consumer failed, or the generator was closed: the chunks still queued are not simulated
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+    def writeData(self, output_format=None, filename=None):
         """A shorter explanation
 
-        In this method inside a loop,the simulation runs calling the method :func:`generateSignalEvent`
+        In this method the simulation runs calling the method :func:`iterEvents`, or :func:`runParallel` if the parameter
+        nworkers is greater than one.
 
-        The events generated are stored in a Tree of a Root file.
+        The theta angle, the position of the particle and the pixels fired per channel of the events generated are given
+        to a writer of the module :mod:`OutputWriter`, that stores them in chunks of flush_every events. By default the
+        format and the file are given by the parameters output_format ('root' if not given) and output_file.
+        If the parameter checkpoint_every is greater than zero, the run is checkpointed, see :func:`runCheckpointed`.
+        If the parameter instrumentation is True, the times of the stages and the counters of the run (see :mod:`Instrumentation`)
+        are written in the JSON file instrumentation_file. If the parameter statistics is True, the summary statistics of the
+        run (see :mod:`Statistics`) are written in the JSON file statistics_file: with the output format 'none' only them are kept.
         """
+        if output_format is None:
+            output_format=getattr(self.param, 'output_format', 'root')
+        if filename is None:
+            filename=getattr(self.param, 'output_file', None)
+        columns=self.columns()
+        instrumentation=self.instrumentation
+        with instrumentation.stage('run'):
+            writer=OutputWriter.openWriter(output_format, filename, columns, getattr(self.param, 'flush_every', 10000))
+            try:
+                if getattr(self.param, 'checkpoint_every', 0)>0:
+                    self.runCheckpointed(writer, columns)
+                else:
+                    if self.nworkers>1:
+                        chunk_size=-(-self.events//self.nworkers) if self.events else 1
+                        results=self.iterParallel(self.nworkers, min(chunk_size, getattr(self.param, 'flush_every', 10000)))
+                    else:
+                        results=self.iterEvents(self.events)
+                    for block in results:
+                        with instrumentation.stage('output'):
+                            writer.write(*block)
+            finally:
+                with instrumentation.stage('output'):
+                    writer.close()
+        if instrumentation.enabled:
+            instrumentation.dump(getattr(self.param, 'instrumentation_file', 'Instrumentation.json'))
+        if self.statistics.enabled:
+            self.statistics.dump(getattr(self.param, 'statistics_file', 'Statistics.json'))
 
-        file_result=ROOT.TFile("Result.root","recreate")
-        tree=ROOT.TTree("Simul","SimulTree")
-        n=np.zeros(self.events,dtype=float)
-        p=np.zeros(self.events,dtype=float)
-        l=[]
-        tree.Branch('theta',n,'theta/D')
-        tree.Branch('sig_position',p,'sig_position/D')
-       # tree.Branch('photon_angle',l,'photon_angle/D')
-        for event in range (self.events):
-            print 'event', event
-            
-            self.generateSignalEvent()
-            #ch=self.setup.getObjectChannel().setNChannel(
-            print 'end_event'	
-            n[event]=self.generateTheta()
-            
-            
-            p[event]=self.generateSignalPosition()
-            #print n[event],p[event]
-         #return self.generateSignalEvent()
-        
-            tree.Fill()
-            self.setup.reset()
-        file_result.Write()
-        file_result.Close()
-        self.plotResults(p,n)
-    def plotResults(self,p,n):
-        pass
+    def runCheckpointed(self, writer, columns):
+        """Runs the simulation saving a checkpoint (see :mod:`Checkpoint`) every checkpoint_every events, and at the end
+        gives all the events to writer.
+
+        The checkpoint is kept in the directory checkpoint_dir (by default the output file followed by .checkpoint). If
+        it already contains a checkpoint of a run with the same parameters, the run continues after the last complete
+        checkpoint and the result is the same of a run never interrupted. The checkpoints are made between two blocks of
+        events, so the random streams of the events that follow do not depend on the events before (see :func:`iterEvents`).
+        With nworkers processes the events are generated in chunks of checkpoint_every events by :func:`iterParallel`.
+        The seed is needed, to build the same geometry again when the run is resumed. The statistics of the run, if any,
+        are saved with the checkpoint. With the output format 'none' the checkpoint keeps only the number of events and the
+        statistics, not the events."""
+        if self.seed is None or not self.substreams:
+            raise ValueError("a seed is needed to checkpoint a run")
+        checkpoint_every=self.param.checkpoint_every
+        dirname=getattr(self.param, 'checkpoint_dir', None) or (writer.filename+'.checkpoint')
+        parameters=dict((name, value) for name, value in vars(self.param).items() if name not in ('nworkers', 'checkpoint_dir'))
+        # a run that keeps only its statistics does not store its events in the checkpoint
+        keep_events=not isinstance(writer, OutputWriter.NullWriter)
+        checkpoint=Checkpoint.Checkpoint(dirname, columns, parameters, getattr(self.param, 'flush_every', 10000), keep_events)
+        state=checkpoint.load()
+        done=state['nevents'] if state else 0
+        statistics=self.statistics
+        if state and statistics.enabled:
+            statistics.load(state['statistics'])
+        save=lambda: checkpoint.save(statistics=statistics.summary() if statistics.enabled else None)
+        instrumentation=self.instrumentation
+        if self.nworkers>1:
+            for block in self.iterParallel(self.nworkers, checkpoint_every, done):
+                with instrumentation.stage('output'):
+                    checkpoint.write(*block)
+                    save()
+        else:
+            saved=done
+            for block in self.iterEvents(self.events-done, done):
+                with instrumentation.stage('output'):
+                    checkpoint.write(*block)
+                    done+=len(block[0])
+                    if done-saved>=checkpoint_every:
+                        save()
+                        saved=done
+        with instrumentation.stage('output'):
+            checkpoint.finish(writer)
+
+    def writeDataRoot(self):
+        """The simulation results are stored in a Tree of the Root file Result.root, see :func:`writeData`"""
+        self.writeData('root', 'Result.root')
+
+    def plotResults(self, filename='Statistics.png'):
+        """Plots the statistics of the run (see :mod:`Statistics`) in filename: the occupancy of the channels, the
+        pixels fired per event, the mean response versus theta and the mean photons per hit fiber versus the impact parameter.
+        It needs matplotlib and the parameter statistics."""
+        if not self.statistics.enabled:
+            raise ValueError("no statistics to plot: set the parameter statistics to True")
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        statistics=self.statistics
+        figure, axes=plt.subplots(2, 2, figsize=(10, 8))
+        axes[0][0].step(np.arange(len(statistics.fired_events)), statistics.occupancy(), where='mid')
+        axes[0][0].set_xlabel('channel')
+        axes[0][0].set_ylabel('occupancy')
+        counts=statistics.multiplicity.counts[1:-1]
+        last=np.flatnonzero(counts)[-1]+1 if counts.any() else 1
+        axes[0][1].bar(statistics.multiplicity.edges[:last], counts[:last], width=1.0)
+        axes[0][1].set_xlabel('pixels fired per event')
+        theta=0.5*(statistics.theta_edges[1:]+statistics.theta_edges[:-1])*180.0/math.pi
+        moments=statistics.response_vs_theta
+        axes[1][0].errorbar(theta, moments.mean, np.sqrt(moments.variance()/np.maximum(moments.n, 1)), fmt='o')
+        axes[1][0].set_xlabel('theta (deg)')
+        axes[1][0].set_ylabel('mean pixels fired per event')
+        moments=statistics.photons_vs_impact
+        axes[1][1].errorbar(FiberSetup.IMPACT_BINS, moments.mean, np.sqrt(moments.variance()), fmt='o')
+        axes[1][1].set_xlabel('impact parameter, upper edge of the bin (um)')
+        axes[1][1].set_ylabel('photons per hit fiber')
+        figure.tight_layout()
+        figure.savefig(filename)
+        plt.close(figure)
 
 
+_worker_event=None
+# Event of a process of the pool of :func:`Event.iterParallel`, built by :func:`_initWorker`
 
 
+def _initWorker(parameter, seed):
+    """Builds the Event of a process of the pool, used for all the chunks of the process"""
+    global _worker_event
+    parameter=copy.copy(parameter)
+    parameter.seed=seed
+    _worker_event=Event(parameter)
 
 
+def _runWorker(chunk):
+    """Work of one process of :func:`Event.iterParallel`: generates the events of the chunk (first event, nevents).
+    The instrumentation and the statistics returned are the ones of the chunk only."""
+    first_event, nevents=chunk
+    simul=_worker_event
+    simul.resetAccumulators()
+    return simul.run(nevents, first_event), simul.instrumentation, simul.statistics
@@ -0,0 +1,122 @@
+# Instrumentation module
+
+"""
+.. module:: Instrumentation
+   :synopsis: Timers and counters of the stages of the simulation
+"""
+import json
+import threading
+import timeit
+
+
+class Instrumentation(object):
+    """Wall time of the stages of the event loop and counters of a run.
+
+       The time of a stage is measured with a with statement::
+
+           with instrumentation.stage('photon_transport'):
+               ...
+
+       and the counters are incremented with :func:`count`. The values are summed over the run, the
+       instrumentations of different processes can be added with :func:`merge` and the result is
+       returned as a dictionary by :func:`summary` or written in a JSON file by :func:`dump`. The stages can be
+       timed from different threads."""
+
+    enabled = True
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Context manager that adds its execution time to the stage name"""
+        return _Stage(self, name)
+
+    def addTime(self, name, seconds, calls=1):
+        with self._lock:
+            self.times[name] = self.times.get(name, 0.0)+seconds
+            self.calls[name] = self.calls.get(name, 0)+calls
+
+    def count(self, name, n=1):
+        """Add n to the counter name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0)+int(n)
+
+    def merge(self, other):
+        """Add the times and the counters of another instrumentation to this one"""
+        for name, seconds in other.times.items():
+            self.addTime(name, seconds, other.calls[name])
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def summary(self):
+        return {'stages': dict((name, {'time': self.times[name], 'calls': self.calls[name]}) for name in self.times),
+                'counters': dict(self.counters)}
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+    def __getstate__(self):
+        # the lock cannot be pickled, to send the instrumentation of a worker to the main process
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class NullInstrumentation(Instrumentation):
+    """Instrumentation that does nothing, used when the instrumentation is disabled.
+
+       Its stage is a shared context manager without timers, so a disabled instrumentation costs only a method call."""
+
+    enabled = False
+
+    def stage(self, name):
+        return _null_stage
+
+    def addTime(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+
+class _Stage(object):
+
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.addTime(self.name, timeit.default_timer()-self.start)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_stage = _NullStage()
+
+NULL = NullInstrumentation()
+"""Disabled instrumentation, the default of the classes of the simulation"""
+
+
+def create(enabled):
+    """Returns a new :class:`Instrumentation` if enabled is True, :data:`NULL` otherwise"""
+    return Instrumentation() if enabled else NULL
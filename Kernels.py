@@ -0,0 +1,170 @@
+# Kernels module
+
+"""
+.. module:: Kernels
+   :synopsis: Compiled loops of the photon transport and of the digitization, used with transport_backend = 'numba'
+
+The functions of this module loop on the photons one by one, as the original scalar code did, and are compiled
+with numba when it is installed. All their random numbers are drawn before the call, in the same order of the
+numpy functions of :class:`Sipm.ChannelArray`, so the two backends use the same random numbers for the same photons.
+Without numba the functions are still correct, but they run as plain python loops: :func:`getBackend` then selects
+the numpy backend.
+"""
+import math
+import warnings
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+    NUMBA_VERSION = numba.__version__
+except ImportError:
+    HAS_NUMBA = False
+    NUMBA_VERSION = None
+
+BACKENDS = ('numpy', 'numba')
+"""Backends of the photon transport and of the digitization, see the parameter transport_backend"""
+
+
+def _jit(function):
+    """Compiles function with numba if it is installed, otherwise returns it unchanged"""
+    if HAS_NUMBA:
+        return numba.njit(cache=True, nogil=True)(function)
+    return function
+
+
+def getBackend(backend):
+    """Backend really used for the backend requested: 'numba' falls back to 'numpy' (with a warning) if numba is not installed"""
+    if backend not in BACKENDS:
+        raise ValueError("unknown transport backend '%s'" % backend)
+    if backend == 'numba' and not HAS_NUMBA:
+        warnings.warn("numba is not installed, the numpy transport backend is used")
+        return 'numpy'
+    return backend
+
+
+@_jit
+def _interp(u, cdf, angles):
+    # as numpy.interp for u inside the table: binary search of the last point of cdf not greater than u
+    low = 0
+    high = len(cdf)-1
+    if u <= cdf[0]:
+        return angles[0]
+    if u >= cdf[high]:
+        return angles[high]
+    while high-low > 1:
+        middle = (low+high)//2
+        if cdf[middle] <= u:
+            low = middle
+        else:
+            high = middle
+    return angles[low]+(u-cdf[low])*(angles[high]-angles[low])/(cdf[high]-cdf[low])
+
+
+@_jit
+def _transport(Xc, Yc, diameter, core_index, photons, uniforms, cdf, angles, radius_bins, epoxy, epoxy_index, channel_height,
+               pixel_width, pixel_height, nx, ny, prob_pde, x_pixel, y_pixel, source, lost):
+    kept = 0
+    photon = 0
+    for fiber in range(len(photons)):
+        for i in range(photons[fiber]):
+            phi = uniforms[0, photon]*math.pi
+            phi_prime = uniforms[1, photon]*math.pi
+            radius = uniforms[2, photon]*diameter[fiber]/2.
+            # emission angle of the radius bin (closed on the right), 0 for a radius out of the bins
+            radius_um = radius*1000000
+            ybin = 0
+            while ybin < len(radius_bins) and radius_bins[ybin] < radius_um:
+                ybin += 1
+            angle = 0.0
+            if ybin < len(radius_bins):
+                angle = _interp(uniforms[3, photon]+ybin, cdf, angles)
+            sin_theta_prime = core_index[fiber]/epoxy_index*math.sin(math.radians(angle))
+            detected = uniforms[4, photon] < prob_pde
+            photon += 1
+            if sin_theta_prime > 1.0:
+                lost[0] += 1
+                continue
+            sin_theta = math.sin(math.asin(sin_theta_prime))
+            xp = Xc[fiber]+radius*math.cos(phi)+math.cos(phi_prime)*sin_theta*epoxy
+            yp = Yc[fiber]+radius*math.sin(phi)+channel_height/2.0+math.sin(phi_prime)*sin_theta*epoxy
+            # int() truncates toward zero like astype(int)
+            x = int(xp/pixel_width)
+            y = int(yp/pixel_height)
+            if x < 0 or x >= nx or y < 0 or y >= ny:
+                lost[1] += 1
+                continue
+            if not detected:
+                lost[2] += 1
+                continue
+            x_pixel[kept] = x
+            y_pixel[kept] = y
+            source[kept] = fiber
+            kept += 1
+    return kept
+
+
+def transportPhotons(channel_array, Xc, Yc, diameter, core_index, photons, uniforms, cdf, angles, radius_bins):
+    """Loop version of :func:`Sipm.ChannelArray.transportPhotons`, with the uniforms (5 x photons) already drawn: for each
+    photon the azimuth of the exit point, the azimuth of the direction, the radius, the emission angle and the pde test.
+    Returns the arrays x_pixel, y_pixel and source of the photons kept, and the numbers of photons lost in the epoxy,
+    out of the detector and for the pde."""
+    photons = np.asarray(photons, dtype=np.int64)
+    n = int(photons.sum())
+    x_pixel = np.empty(n, dtype=np.int64)
+    y_pixel = np.empty(n, dtype=np.int64)
+    source = np.empty(n, dtype=np.int64)
+    lost = np.zeros(3, dtype=np.int64)
+    arrays = [np.ascontiguousarray(a, dtype=float) for a in (Xc, Yc, diameter, core_index)]
+    kept = _transport(arrays[0], arrays[1], arrays[2], arrays[3], photons, np.ascontiguousarray(uniforms), cdf, angles, radius_bins,
+                      channel_array.epoxy, channel_array.epoxy_index, channel_array.channel_height, channel_array.pixel_width,
+                      channel_array.pixel_height, channel_array.pixel_x_size*channel_array.channel_number, channel_array.pixel_y_size,
+                      channel_array.prob_pde, x_pixel, y_pixel, source, lost)
+    return x_pixel[:kept], y_pixel[:kept], source[:kept], lost
+
+
+@_jit
+def _countFiredPixels(event, x_pixel, y_pixel, nevents, pixel_x_size, pixel_y_size, channel_number, response):
+    # the pixels of the photons are grouped by event with a counting sort, then sorted within each event:
+    # a pixel is counted once, where it differs from the previous one
+    first = np.zeros(nevents+1, dtype=np.int64)
+    for i in range(len(event)):
+        first[event[i]+1] += 1
+    for e in range(nevents):
+        first[e+1] += first[e]
+    position = first[:-1].copy()
+    pixels = np.empty(len(event), dtype=np.int64)
+    for i in range(len(event)):
+        pixels[position[event[i]]] = x_pixel[i]*pixel_y_size+y_pixel[i]
+        position[event[i]] += 1
+    for e in range(nevents):
+        pixels[first[e]:first[e+1]].sort()
+        previous = -1
+        for j in range(first[e], first[e+1]):
+            if pixels[j] != previous:
+                previous = pixels[j]
+                response[e, pixels[j]//pixel_y_size//pixel_x_size] += 1
+
+
+def countFiredPixels(channel_array, event, x_pixel, y_pixel, nevents):
+    """Loop version of :func:`Sipm.ChannelArray.countFiredPixels`"""
+    response = np.zeros((nevents, channel_array.channel_number), dtype=np.int64)
+    _countFiredPixels(np.asarray(event, dtype=np.int64), np.asarray(x_pixel, dtype=np.int64), np.asarray(y_pixel, dtype=np.int64),
+                      nevents, channel_array.pixel_x_size, channel_array.pixel_y_size, channel_array.channel_number, response)
+    return response
+
+
+@_jit
+def _countChannelPixels(pixels, pixel_x_size, pixel_lit_per_channel):
+    for x in range(pixels.shape[0]):
+        count = 0
+        for y in range(pixels.shape[1]):
+            if pixels[x, y]:
+                count += 1
+        pixel_lit_per_channel[x//pixel_x_size] += count
+
+
+def countChannelPixels(channel_array):
+    """Loop version of :func:`Sipm.ChannelArray.fillChannelArray`: fills pixel_lit_per_channel from the pixels matrix"""
+    channel_array.pixel_lit_per_channel.fill(0)
+    _countChannelPixels(channel_array.pixels, channel_array.pixel_x_size, channel_array.pixel_lit_per_channel)
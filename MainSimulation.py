@@ -1,18 +1,9 @@
-import numpy as np
 import sys
-import ROOT
-import FiberSetup
-import Sipm
 import GenerateEvent
-import AngularDistribution
 #import TestModule
 
 
 
-import unittest
-
-
-
 
             
 
@@ -22,7 +13,9 @@ class Parameters:
 
        These parameter are stored in a config.py file that has to be passed when
        the execution comand is given.
-       Es: python MainSimulation.py config.py"""
+       Es: python MainSimulation.py config.py
+       ROOT is not needed to run the simulation: it is imported only to write the results
+       in the 'root' output format (see :mod:`OutputWriter`)."""
     def __init__(self, filename):
         with open(filename, 'r') as f:
             for line in f:
@@ -37,4 +30,4 @@ if __name__== "__main__":
     parameter = Parameters(sys.argv[1])
     simul=GenerateEvent.Event(parameter)
 
-    simul.writeDataRoot()
+    simul.writeData()
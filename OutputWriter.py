@@ -0,0 +1,380 @@
+# OutputWriter module
+
+"""
+.. module:: OutputWriter
+   :synopsis: Buffered writers of the simulation results in different formats
+"""
+import io
+import json
+import os
+import zipfile
+import numpy as np
+
+
+def eventColumns(channel_number, max_tracks=0):
+    """Columns stored for each event: (name, dtype, shape of one event).
+
+       theta and X0 are the angle and the position of the simulated particle, pixel_lit_per_channel
+       is the number of pixels fired in each channel of the detector. With pile-up (max_tracks greater than zero)
+       theta and X0 are the ones of the first track, ntracks is the number of tracks of the event and track_theta
+       and track_X0 the angles and the positions of its tracks, padded with nan up to max_tracks."""
+    columns = [('theta', np.float64, ()),
+               ('X0', np.float64, ()),
+               ('pixel_lit_per_channel', np.int32, (channel_number,))]
+    if max_tracks > 0:
+        columns += [('ntracks', np.int32, ()),
+                    ('track_theta', np.float64, (max_tracks,)),
+                    ('track_X0', np.float64, (max_tracks,))]
+    return columns
+
+
+class OutputWriter(object):
+    """Base class of the output writers.
+
+       The events are given to :func:`write`, one or a block at a time, as one array for each column. They are kept
+       in a buffer and written to the file in chunks of flush_every events by :func:`writeChunk`, that each format
+       has to implement together with :func:`closeFile`. A writer can be used in a with statement, that closes it."""
+
+    extension = ''
+
+    def __init__(self, filename, columns, flush_every=10000):
+
+        self.filename = filename
+        self.columns = [(name, np.dtype(dtype), tuple(shape)) for name, dtype, shape in columns]
+        self.flush_every = flush_every
+        self.nevents = 0
+        # number of events already written in the file
+        self._buffer = [[] for column in self.columns]
+        self._buffered = 0
+
+    def write(self, *values):
+        """Add events to the buffer: one value (one event) or array (a block of events) for each column, in the order of columns"""
+        if len(values) != len(self.columns):
+            raise ValueError("%d columns expected, %d given" % (len(self.columns), len(values)))
+        nevents = None
+        for buffer, (name, dtype, shape), value in zip(self._buffer, self.columns, values):
+            value = np.asarray(value, dtype=dtype)
+            if value.shape == shape:
+                value = value[np.newaxis]
+            if value.shape[1:] != shape or (nevents is not None and len(value) != nevents):
+                raise ValueError("wrong shape %s for the column %s" % (value.shape, name))
+            nevents = len(value)
+            buffer.append(value)
+        self._buffered += nevents
+        if self._buffered >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write to the file the events of the buffer"""
+        if self._buffered == 0:
+            return
+        chunk = dict((name, np.concatenate(buffer)) for (name, dtype, shape), buffer in zip(self.columns, self._buffer))
+        self.writeChunk(chunk)
+        self.nevents += self._buffered
+        self._buffer = [[] for column in self.columns]
+        self._buffered = 0
+
+    def close(self):
+        """Flush the buffer and close the file"""
+        self.flush()
+        self.closeFile()
+
+    def writeChunk(self, chunk):
+        raise NotImplementedError
+
+    def closeFile(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RootWriter(OutputWriter):
+    """Writer of a ROOT file with a TTree called Simul, with one branch for each column.
+
+       For compatibility with the old files, the branch of X0 is called sig_position. PyROOT has no bulk
+       fill from numpy, so the tree is still filled one entry at a time, but only when a chunk is flushed."""
+
+    extension = '.root'
+    branch_names = {'X0': 'sig_position'}
+    leaf_types = {'f8': 'D', 'f4': 'F', 'i4': 'I', 'i8': 'L'}
+
+    def __init__(self, filename, columns, flush_every=10000):
+
+        OutputWriter.__init__(self, filename, columns, flush_every)
+        import ROOT
+        self.file_result = ROOT.TFile(filename, "recreate")
+        self.tree = ROOT.TTree("Simul", "SimulTree")
+        self.addresses = {}
+        for name, dtype, shape in self.columns:
+            branch = self.branch_names.get(name, name)
+            self.addresses[name] = np.zeros(shape or (1,), dtype=dtype)
+            dimensions = ''.join('[%d]' % n for n in shape)
+            self.tree.Branch(branch, self.addresses[name], '%s%s/%s' % (branch, dimensions, self.leaf_types[dtype.str[1:]]))
+
+    def writeChunk(self, chunk):
+        for event in range(len(chunk[self.columns[0][0]])):
+            for name, address in self.addresses.items():
+                address[...] = chunk[name][event]
+            self.tree.Fill()
+
+    def closeFile(self):
+        self.file_result.Write()
+        self.file_result.Close()
+
+
+class NpzWriter(OutputWriter):
+    """Writer of a compressed numpy .npz file.
+
+       Each flushed chunk is added to the zip archive as one .npy member per column, called <column>_<chunk number>,
+       so the file never has to be rewritten. :func:`readNpz` joins the chunks of each column."""
+
+    extension = '.npz'
+
+    def __init__(self, filename, columns, flush_every=10000):
+
+        OutputWriter.__init__(self, filename, columns, flush_every)
+        self.archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.nchunks = 0
+
+    def writeChunk(self, chunk):
+        for name, dtype, shape in self.columns:
+            member = io.BytesIO()
+            np.lib.format.write_array(member, chunk[name])
+            self.archive.writestr('%s_%06d.npy' % (name, self.nchunks), member.getvalue())
+        self.nchunks += 1
+
+    def closeFile(self):
+        self.archive.close()
+
+
+def readNpz(filename):
+    """Returns a dictionary with the full array of each column of a file written by :class:`NpzWriter`"""
+    data = np.load(filename)
+    try:
+        chunks = {}
+        for key in sorted(data.files):
+            name = key.rsplit('_', 1)[0]
+            chunks.setdefault(name, []).append(data[key])
+        return dict((name, np.concatenate(arrays)) for name, arrays in chunks.items())
+    finally:
+        data.close()
+
+
+class HDF5Writer(OutputWriter):
+    """Writer of a HDF5 file (it needs h5py), with one chunked and compressed dataset for each column.
+
+       The datasets are extendable along the event axis and are resized at every flush."""
+
+    extension = '.h5'
+
+    def __init__(self, filename, columns, flush_every=10000):
+
+        OutputWriter.__init__(self, filename, columns, flush_every)
+        import h5py
+        self.h5file = h5py.File(filename, 'w')
+        for name, dtype, shape in self.columns:
+            self.h5file.create_dataset(name, (0,)+shape, dtype=dtype, maxshape=(None,)+shape,
+                                       chunks=(max(1, min(flush_every, 65536)),)+shape, compression='gzip')
+
+    def writeChunk(self, chunk):
+        for name, dtype, shape in self.columns:
+            dataset = self.h5file[name]
+            dataset.resize(self.nevents+len(chunk[name]), axis=0)
+            dataset[self.nevents:] = chunk[name]
+
+    def closeFile(self):
+        self.h5file.close()
+
+
+class BinaryWriter(OutputWriter):
+    """Writer of a raw binary columnar result.
+
+       filename is a directory with one raw little-endian file <column>.bin for each column, where the events are
+       written one after the other, and a file header.json with the dtype and the shape of each column and the number
+       of events. The header is updated at every flush, so the files written so far can always be read, without copies,
+       by :class:`BinaryReader`.
+       If keep_events is given, the first keep_events events already in the files are kept, anything after
+       them is removed, and the new events are written after them."""
+
+    extension = '.bin'
+
+    def __init__(self, filename, columns, flush_every=10000, keep_events=0):
+
+        OutputWriter.__init__(self, filename, columns, flush_every)
+        if not os.path.isdir(filename):
+            os.makedirs(filename)
+        self.files = {}
+        for name, dtype, shape in self.columns:
+            f = open(os.path.join(filename, name+'.bin'), 'r+b' if keep_events else 'wb')
+            f.truncate(keep_events*dtype.itemsize*int(np.prod(shape)))
+            f.seek(0, os.SEEK_END)
+            self.files[name] = f
+        self.nevents = keep_events
+        self.writeHeader()
+
+    def writeHeader(self):
+        header = {'nevents': self.nevents,
+                  'columns': [{'name': name, 'dtype': dtype.newbyteorder('<').str, 'shape': list(shape)}
+                              for name, dtype, shape in self.columns]}
+        with open(os.path.join(self.filename, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+
+    def writeChunk(self, chunk):
+        for name, dtype, shape in self.columns:
+            chunk[name].astype(dtype.newbyteorder('<'), copy=False).tofile(self.files[name])
+            self.files[name].flush()
+
+    def flush(self):
+        OutputWriter.flush(self)
+        self.writeHeader()
+
+    def sync(self):
+        """Flush the buffer and force the files to the disk"""
+        self.flush()
+        for f in self.files.values():
+            os.fsync(f.fileno())
+
+    def closeFile(self):
+        for f in self.files.values():
+            f.close()
+
+
+class NullWriter(OutputWriter):
+    """Writer that discards the events, for the runs that keep only their statistics (see :mod:`Statistics`)"""
+
+    def writeChunk(self, chunk):
+        pass
+
+    def closeFile(self):
+        pass
+
+
+class BinaryReader(object):
+    """Reader of a result written by :class:`BinaryWriter`.
+
+       The column files are opened with numpy.memmap, so opening a result costs only the reading of the header
+       and the events are read from the disk only when they are used. A column is selected with reader['theta'],
+       a range of events with :func:`read` (or reader[start:stop]) and the events are iterated in chunks with
+       :func:`iterChunks`: in all the cases the arrays returned are views of the files, not copies.
+       The events are the ones counted in the header, so a result still being written can be read."""
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        with open(os.path.join(filename, 'header.json')) as f:
+            header = json.load(f)
+        self.nevents = header['nevents']
+        self.columns = [(str(column['name']), np.dtype(str(column['dtype'])), tuple(column['shape'])) for column in header['columns']]
+        self._arrays = {}
+
+    def __len__(self):
+        return self.nevents
+
+    def column(self, name):
+        """Array of all the events of the column name, mapped in memory"""
+        if name in self._arrays:
+            return self._arrays[name]
+        for column, dtype, shape in self.columns:
+            if column == name:
+                break
+        else:
+            raise KeyError("no column %s in %s" % (name, self.filename))
+        if self.nevents == 0:
+            array = np.zeros((0,)+shape, dtype=dtype)
+        else:
+            array = np.memmap(os.path.join(self.filename, name+'.bin'), dtype=dtype, mode='r', shape=(self.nevents,)+shape)
+        self._arrays[name] = array
+        return array
+
+    def names(self):
+        return [name for name, dtype, shape in self.columns]
+
+    def read(self, start=0, stop=None, columns=None):
+        """Dictionary with the events from start to stop of the columns given (by default all)"""
+        return dict((name, self.column(name)[start:stop]) for name in (columns or self.names()))
+
+    def iterChunks(self, chunk_size=10000, columns=None, start=0, stop=None):
+        """Yields the events from start to stop in chunks of chunk_size events, as dictionaries of columns (see :func:`read`)"""
+        stop = self.nevents if stop is None else min(stop, self.nevents)
+        for first in range(start, stop, chunk_size):
+            yield self.read(first, min(first+chunk_size, stop), columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.column(key)
+        return dict((name, self.column(name)[key]) for name in self.names())
+
+    def close(self):
+        """Releases the maps of the files. The arrays already returned stay valid."""
+        self._arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def readBinaryChunks(filename, chunk_size=10000):
+    """Reads a result written by :class:`BinaryWriter` in chunks of chunk_size events.
+       It is a generator that yields a dictionary with the array of each column for each chunk (see :class:`BinaryReader`)."""
+    with BinaryReader(filename) as reader:
+        for chunk in reader.iterChunks(chunk_size):
+            yield chunk
+
+
+def readNpzChunks(filename):
+    """Reads a file written by :class:`NpzWriter` one chunk at a time.
+       It is a generator that yields a dictionary with the array of each column for each chunk."""
+    data = np.load(filename)
+    try:
+        members = {}
+        for key in data.files:
+            name, number = key.rsplit('_', 1)
+            members.setdefault(int(number), []).append((name, key))
+        for number in sorted(members):
+            yield dict((name, data[key]) for name, key in members[number])
+    finally:
+        data.close()
+
+
+def readChunks(filename, chunk_size=10000):
+    """Reads a result in the npz, hdf5 or binary format in chunks of events, so a result of any size can be read
+       in bounded memory. It is a generator that yields a dictionary with the array of each column for each chunk.
+       The npz files are read in the chunks in which they were written."""
+    if os.path.isdir(filename):
+        return readBinaryChunks(filename, chunk_size)
+    if filename.endswith(NpzWriter.extension):
+        return readNpzChunks(filename)
+    if filename.endswith(HDF5Writer.extension):
+        return _readHDF5Chunks(filename, chunk_size)
+    raise ValueError("cannot read '%s' in chunks: the formats are npz, hdf5 and binary" % filename)
+
+
+def _readHDF5Chunks(filename, chunk_size):
+    import h5py
+    with h5py.File(filename, 'r') as h5file:
+        names = list(h5file.keys())
+        nevents = len(h5file[names[0]]) if names else 0
+        for first in range(0, nevents, chunk_size):
+            yield dict((name, h5file[name][first:first+chunk_size]) for name in names)
+
+
+WRITERS = {'root': RootWriter, 'npz': NpzWriter, 'hdf5': HDF5Writer, 'binary': BinaryWriter, 'none': NullWriter}
+"""Output formats available, the keys are the values accepted by the parameter output_format"""
+
+
+def openWriter(output_format, filename, columns, flush_every=10000):
+    """Returns the writer of the format output_format for the file filename.
+       If filename is None, it is Result with the extension of the format."""
+    try:
+        writer = WRITERS[output_format]
+    except KeyError:
+        raise ValueError("unknown output format '%s', the formats are %s" % (output_format, ', '.join(sorted(WRITERS))))
+    if filename is None:
+        filename = 'Result'+writer.extension
+    return writer(filename, columns, flush_every)
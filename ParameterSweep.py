@@ -0,0 +1,141 @@
+# ParameterSweep module
+
+"""
+.. module:: ParameterSweep
+   :synopsis: Simulation of a grid of configurations that differ only in some parameters
+
+Es: python ParameterSweep.py config.py --axis prob_pde=0.2,0.25,0.3 --axis epoxy=100e-06,120e-06 -o sweep -j 4
+
+Each point of the grid is written in the output directory as point_<number> in the format of the parameter
+output_format (or --format), together with point_<number>.json, that contains all the parameters of the point.
+"""
+import argparse
+import ast
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+import FiberSetup
+import GenerateEvent
+import MainSimulation
+import OutputWriter
+import RandomService
+
+
+def makeGrid(axes):
+    """List of the points of the grid: axes is a list of (parameter name, list of values) and each point
+       is a dictionary with one value for each axis. The last axis changes faster."""
+    names = [name for name, values in axes]
+    return [dict(zip(names, values)) for values in itertools.product(*[values for name, values in axes])]
+
+
+def configure(parameter, point):
+    """Copy of the parameters with the values of the point"""
+    parameter = copy.copy(parameter)
+    for name, value in point.items():
+        setattr(parameter, name, value)
+    return parameter
+
+
+_setups = {}
+# setups already built by this process, by geometry and seed, see :func:`getSetup`
+
+
+def getSetup(parameter, seed):
+    """Returns a :class:`FiberSetup.Setup` with the geometry of parameter, built only the first time that the
+       geometry and the seed are requested in this process. The sampler tables are shared in the same way
+       by :func:`Sampling.getSampler`, so only the channel array has to be built again for each point."""
+    key = tuple(getattr(parameter, name) for name in FiberSetup.GEOMETRY_PARAMETERS)+(seed,)
+    try:
+        return _setups[key]
+    except KeyError:
+        setup = _setups[key] = FiberSetup.Setup(parameter, RandomService.RandomService(seed).geometry())
+        return setup
+
+
+def runPoint(task):
+    """Simulates one point of the sweep: task is (number of the point, point, base parameters, seed, output directory).
+
+    The geometry and the events take their random numbers from the streams of the seed (see :mod:`RandomService`),
+    so every point uses the same random numbers and the differences between the points are due only to the
+    parameters. The files of the point are called point_NNNN (the number of the point) followed by their extension.
+    Returns the name of the result file."""
+    number, point, parameter, seed, outdir = task
+    parameter = configure(parameter, point)
+    parameter.seed = seed
+    parameter.nworkers = 1
+    writer = OutputWriter.WRITERS[parameter.output_format]
+    basename = os.path.join(outdir, 'point_%04d' % number)
+    # each point writes its own files, the points can run at the same time
+    parameter.instrumentation_file = basename+'.instrumentation.json'
+    parameter.statistics_file = basename+'.statistics.json'
+    parameter.checkpoint_dir = basename+'.checkpoint'
+    simul = GenerateEvent.Event(parameter, setup=getSetup(parameter, seed))
+    simul.writeData(parameter.output_format, basename+writer.extension)
+
+    description = {'point': point, 'parameters': vars(parameter), 'output_file': basename+writer.extension}
+    if simul.instrumentation.enabled:
+        description['instrumentation'] = simul.instrumentation.summary()
+    if simul.statistics.enabled:
+        description['statistics_file'] = parameter.statistics_file
+    with open(basename+'.json', 'w') as f:
+        json.dump(description, f, indent=1, sort_keys=True)
+    return basename+writer.extension
+
+
+def runSweep(parameter, axes, outdir, nworkers=1):
+    """Simulates all the points of the grid given by axes (see :func:`makeGrid`), with the other parameters taken
+       from parameter, in nworkers processes. Returns the list of the result files, in the order of the points.
+
+       The points with the same geometry share the fiber stack when they run in the same process. If the parameters
+       have no seed, one is drawn for the whole sweep."""
+    seed = getattr(parameter, 'seed', None)
+    if seed is None:
+        seed = np.random.randint(2**31)
+    parameter = configure(parameter, {'output_format': getattr(parameter, 'output_format', 'root')})
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tasks = [(number, point, parameter, seed, outdir) for number, point in enumerate(makeGrid(axes))]
+    if nworkers <= 1:
+        return [runPoint(task) for task in tasks]
+    pool = multiprocessing.Pool(nworkers)
+    try:
+        # consecutive points usually share the geometry, so they are given to the same process
+        return pool.map(runPoint, tasks, chunksize=max(1, len(tasks)//nworkers))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parseAxis(text):
+    """Parses an axis of the command line, name=value1,value2,... The values are python literals."""
+    name, sep, values = text.partition('=')
+    if not sep or not values:
+        raise argparse.ArgumentTypeError("the axis '%s' is not in the form name=value1,value2,..." % text)
+    values = ast.literal_eval(values+',')
+    return name.strip(), list(values)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulation of a grid of parameters')
+    parser.add_argument('config', help='configuration file with the base parameters')
+    parser.add_argument('-a', '--axis', type=parseAxis, action='append', required=True,
+                        help='parameter to change and its values, es: prob_pde=0.2,0.25')
+    parser.add_argument('-o', '--outdir', default='sweep', help='directory of the results')
+    parser.add_argument('-j', '--nworkers', type=int, default=1, help='number of processes')
+    parser.add_argument('--format', choices=sorted(OutputWriter.WRITERS), help='output format, by default output_format')
+    args = parser.parse_args(argv)
+
+    parameter = MainSimulation.Parameters(args.config)
+    if args.format:
+        parameter.output_format = args.format
+    for filename in runSweep(parameter, args.axis, args.outdir, args.nworkers):
+        print(filename)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# Pipeline module
+
+"""
+.. module:: Pipeline
+   :synopsis: Stages of the simulation running in threads connected by bounded queues
+"""
+import threading
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class _Failure(object):
+    """Exception raised in a stage, passed along the queues up to the consumer"""
+
+    def __init__(self, exception):
+        self.exception = exception
+        self.exception.pipeline_traceback = traceback.format_exc()
+
+
+_END = object()
+# put in the queues after the last item
+
+
+class Pipeline(object):
+    """Chain of stages, each running in its own thread.
+
+       The items of source are given to the first stage, the results of each stage to the next one, and the results of the
+       last stage are yielded by iterating on the pipeline, in the order of source. The stages are connected by queues of
+       queue_size items, so a stage that is faster than the next one waits (backpressure) and the memory is bounded.
+       The threads overlap where the stages release the GIL, as numpy, compression and file I/O do.
+
+       An exception raised by the source or by a stage stops the pipeline and is raised again by the iteration, with the
+       original traceback in its attribute pipeline_traceback. If the consumer stops iterating, the threads are stopped."""
+
+    def __init__(self, source, stages, queue_size=2):
+
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+
+    def _put(self, output, item):
+        while not self._stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, input):
+        while not self._stop.is_set():
+            try:
+                return input.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _produce(self, output):
+        try:
+            for item in self.source:
+                if not self._put(output, item):
+                    return
+        except Exception as exception:
+            self._put(output, _Failure(exception))
+            return
+        self._put(output, _END)
+
+    def _process(self, stage, input, output):
+        while True:
+            item = self._get(input)
+            if item is _END or isinstance(item, _Failure):
+                self._put(output, item)
+                return
+            try:
+                result = stage(item)
+            except Exception as exception:
+                self._put(output, _Failure(exception))
+                return
+            if not self._put(output, result):
+                return
+
+    def __iter__(self):
+        queues = [queue.Queue(self.queue_size) for i in range(len(self.stages)+1)]
+        threads = [threading.Thread(target=self._produce, args=(queues[0],))]
+        threads += [threading.Thread(target=self._process, args=(stage, queues[i], queues[i+1]))
+                    for i, stage in enumerate(self.stages)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exception
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,114 @@
+# RandomService module
+
+"""
+.. module:: RandomService
+   :synopsis: Seeded random streams of the simulation, one for the geometry and one for each group of events
+
+All the random numbers of a run come from a :class:`RandomService` built with the seed of the run. The stream of
+a group of events depends only on the seed and on the index of the first event of the group, so the events are the
+same whatever the order in which the groups are generated or the processes that generate them.
+"""
+import numpy as np
+
+
+HAS_PHILOX = hasattr(np.random, 'Philox')
+"""True if numpy has the counter-based generator Philox (numpy >= 1.17), otherwise the streams are Mersenne Twisters"""
+
+GEOMETRY = 0
+EVENTS = 1
+TEMPLATES = 2
+# kinds of stream, part of the key of the generator together with the seed and the index
+
+
+def createGenerator(seed, kind, index):
+    """Independent numpy generator of the stream (seed, kind, index).
+
+       With Philox the seed is the key and (index, kind) are the high words of the counter, so the streams are
+       disjoint blocks of the same sequence; without it, a RandomState is seeded with the three numbers."""
+    if HAS_PHILOX:
+        return np.random.Generator(np.random.Philox(key=seed, counter=[0, 0, index, kind]))
+    return np.random.RandomState([seed, kind, index])
+
+
+class RandomStream(object):
+    """Random stream that draws its numbers in bulk.
+
+       The uniform and normal numbers are taken from buffers filled by the generator, so a draw of one or few numbers
+       costs a slice instead of a call to the generator. The first fill is as large as the first draw (at least
+       first_fill numbers) and each following one doubles, up to buffer_size: a stream used for few numbers, as the
+       stream of one event, does not pay for a full buffer. It has the methods uniform,
+       normal, binomial and poisson of numpy.random, so it can be used wherever a RandomState is accepted."""
+
+    first_fill = 64
+
+    def __init__(self, generator, buffer_size=4096):
+
+        self.generator = generator
+        self.buffer_size = buffer_size
+        self._uniform_fill = self._normal_fill = min(self.first_fill, buffer_size)
+        self._uniforms = np.empty(0)
+        self._uniform_position = 0
+        self._normals = np.empty(0)
+        self._normal_position = 0
+
+    def uniforms(self, n):
+        """Next n uniform numbers in [0, 1). The array returned is a view of the buffer, it must not be modified."""
+        available = len(self._uniforms)-self._uniform_position
+        if n > available:
+            fresh = self.generator.uniform(size=max(self._uniform_fill, n-available))
+            self._uniform_fill = min(2*self._uniform_fill, self.buffer_size)
+            self._uniforms = np.concatenate((self._uniforms[self._uniform_position:], fresh))
+            self._uniform_position = 0
+        values = self._uniforms[self._uniform_position:self._uniform_position+n]
+        self._uniform_position += n
+        return values
+
+    def normals(self, n):
+        """Next n standard normal numbers. The array returned is a view of the buffer, it must not be modified."""
+        available = len(self._normals)-self._normal_position
+        if n > available:
+            fresh = self.generator.standard_normal(size=max(self._normal_fill, n-available))
+            self._normal_fill = min(2*self._normal_fill, self.buffer_size)
+            self._normals = np.concatenate((self._normals[self._normal_position:], fresh))
+            self._normal_position = 0
+        values = self._normals[self._normal_position:self._normal_position+n]
+        self._normal_position += n
+        return values
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        if size is None:
+            return low+(high-low)*float(self.uniforms(1)[0])
+        return low+(high-low)*self.uniforms(int(np.prod(size))).reshape(size)
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        if size is None:
+            return loc+scale*float(self.normals(1)[0])
+        return loc+scale*self.normals(int(np.prod(size))).reshape(size)
+
+    def binomial(self, n, p, size=None):
+        """Binomial numbers, drawn directly by the generator"""
+        return self.generator.binomial(n, p, size)
+
+    def poisson(self, lam=1.0, size=None):
+        """Poisson numbers, drawn directly by the generator"""
+        return self.generator.poisson(lam, size)
+
+
+class RandomService(object):
+    """Random streams of a run with the given seed (one is drawn if seed is None).
+
+       :func:`geometry` is the stream used to build the setup and :func:`events` the stream of the events that
+       start from the event index given."""
+
+    def __init__(self, seed=None, buffer_size=4096):
+
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed = seed
+        self.buffer_size = buffer_size
+
+    def geometry(self):
+        return RandomStream(createGenerator(self.seed, GEOMETRY, 0), self.buffer_size)
+
+    def events(self, first_event):
+        return RandomStream(createGenerator(self.seed, EVENTS, first_event), self.buffer_size)
@@ -0,0 +1,118 @@
+# Reconstruction module
+
+"""
+.. module:: Reconstruction
+   :synopsis: Cluster finding and reconstruction of the particle position from the pixels fired per channel
+
+Es: python Reconstruction.py config.py Result.npz -o Reconstruction.npz
+
+The result of a simulation is read in chunks (see :func:`OutputWriter.readChunks`), so its size is not limited
+by the memory. For each event the reconstructed position, the size and the charge of the main cluster and the
+number of clusters are written in the output file, together with the generated theta and X0.
+"""
+import argparse
+import sys
+import numpy as np
+import MainSimulation
+import OutputWriter
+
+
+def findClusters(response, threshold=1):
+    """Finds the clusters of all the events of the matrix response (events x channel_number) of the pixels fired per channel.
+
+    A cluster is a group of contiguous channels with at least threshold pixels fired. The channels over threshold of all
+    the events are found with one array operation, and the clusters start and end where the mask changes along the
+    channel axis, so there is no loop over the events. Returns a dictionary of arrays with one element per cluster,
+    in event order: event, first_channel, size (number of channels), charge (pixels fired in the cluster) and centroid
+    (position weighted with the pixels fired, in channel units: the center of channel i is i+0.5)."""
+    response = np.asarray(response)
+    nevents, nchannels = response.shape
+    over = response >= threshold
+    # one channel under threshold at both sides of each event, so every cluster has a start and an end in the same row
+    edges = np.diff(np.pad(over, ((0, 0), (1, 1)), 'constant').view(np.int8), axis=1)
+    event, first = np.nonzero(edges == 1)
+    last = np.nonzero(edges == -1)[1]
+    weights = np.where(over, response, 0)
+    charge = np.pad(np.cumsum(weights, axis=1), ((0, 0), (1, 0)), 'constant')
+    moment = np.pad(np.cumsum(weights*(np.arange(nchannels)+0.5), axis=1), ((0, 0), (1, 0)), 'constant')
+    cluster_charge = charge[event, last]-charge[event, first]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid = (moment[event, last]-moment[event, first])/cluster_charge
+    return {'event': event, 'first_channel': first, 'size': last-first, 'charge': cluster_charge, 'centroid': centroid}
+
+
+def reconstructEvents(response, channel_width, threshold=1):
+    """Reconstructs the position of the particle in each event of response (events x channel_number).
+
+    The position is the centroid of the cluster with the largest charge (the first one if two have the same charge),
+    converted in m with the channel_width. Returns a dictionary of arrays with one element per event: position (nan if
+    the event has no cluster), size and charge of the cluster (0 if no cluster) and nclusters."""
+    response = np.asarray(response)
+    nevents = len(response)
+    clusters = findClusters(response, threshold)
+    event = clusters['event']
+    nclusters = np.bincount(event, minlength=nevents)
+    # clusters sorted by event and decreasing charge: the main cluster of each event is the first of its group
+    order = np.lexsort((-clusters['charge'], event))
+    main = order[np.concatenate(([0], np.cumsum(nclusters)[:-1]))[nclusters > 0]]
+    with_cluster = nclusters > 0
+    position = np.full(nevents, np.nan)
+    position[with_cluster] = clusters['centroid'][main]*channel_width
+    size = np.zeros(nevents, dtype=int)
+    size[with_cluster] = clusters['size'][main]
+    charge = np.zeros(nevents, dtype=response.dtype)
+    charge[with_cluster] = clusters['charge'][main]
+    return {'position': position, 'size': size, 'charge': charge, 'nclusters': nclusters}
+
+
+def reconstructionColumns():
+    """Columns written by :func:`reconstructFile`, as in :func:`OutputWriter.eventColumns`"""
+    return [('theta', np.float64, ()),
+            ('X0', np.float64, ()),
+            ('position', np.float64, ()),
+            ('size', np.int32, ()),
+            ('charge', np.int32, ()),
+            ('nclusters', np.int32, ())]
+
+
+def reconstructFile(filename, channel_width, threshold=1, output_format='npz', output=None, chunk_size=20000):
+    """Reconstructs all the events of a result in the npz, hdf5 or binary format, chunk_size events at a time, and writes the
+    reconstructed events with a writer of :mod:`OutputWriter`. Returns the number of events, and the mean and the standard
+    deviation of the residual position-X0 of the events with a cluster."""
+    nevents = 0
+    residuals = np.zeros(3)
+    # number, sum and sum of the squares of the residuals
+    writer = OutputWriter.openWriter(output_format, output, reconstructionColumns(), chunk_size)
+    try:
+        for chunk in OutputWriter.readChunks(filename, chunk_size):
+            events = reconstructEvents(chunk['pixel_lit_per_channel'], channel_width, threshold)
+            writer.write(chunk['theta'], chunk['X0'], events['position'], events['size'], events['charge'], events['nclusters'])
+            residual = (events['position']-chunk['X0'])[events['nclusters'] > 0]
+            residuals += (len(residual), residual.sum(), (residual**2).sum())
+            nevents += len(chunk['X0'])
+    finally:
+        writer.close()
+    n, total, total2 = residuals
+    mean = total/n if n else np.nan
+    return nevents, mean, np.sqrt(max(total2/n-mean**2, 0.0)) if n else np.nan
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reconstruction of the particle position')
+    parser.add_argument('config', help='configuration file of the simulation')
+    parser.add_argument('result', help='result of the simulation (npz, hdf5 or binary)')
+    parser.add_argument('-o', '--output', default='Reconstruction.npz', help='file of the reconstructed events')
+    parser.add_argument('--format', default='npz', choices=sorted(OutputWriter.WRITERS), help='format of the output')
+    parser.add_argument('-t', '--threshold', type=int, help='pixels fired for a channel to be in a cluster, by default cluster_threshold')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='events reconstructed together')
+    args = parser.parse_args(argv)
+
+    parameter = MainSimulation.Parameters(args.config)
+    threshold = args.threshold if args.threshold is not None else getattr(parameter, 'cluster_threshold', 1)
+    nevents, mean, sigma = reconstructFile(args.result, parameter.ch_width, threshold, args.format, args.output, args.chunk_size)
+    print('%d events, residual position-X0: mean %g m, standard deviation %g m' % (nevents, mean, sigma))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+# Sampling module
+
+"""
+.. module:: Sampling
+   :synopsis: Tabulated inverse-CDF samplers for the distributions used in the simulation
+"""
+import numpy as np
+
+
+class InverseCDFSampler(object):
+    """Sampler of a one dimensional distribution, tabulated once as an inverse cumulative distribution.
+
+       The distribution is given by its values on a grid of points between xmin and xmax. The cumulative
+       distribution is computed once with the trapezoidal rule, then each random number is obtained
+       inverting it for a uniform random number, so any number of values can be drawn with one call
+       of :func:`sample`.
+       As in TF1::GetRandom, the negative values of the distribution are taken in absolute value."""
+
+    def __init__(self, x, pdf):
+
+        x = np.asarray(x, dtype=float)
+        pdf = np.abs(np.asarray(pdf, dtype=float))
+        area = 0.5*(pdf[1:]+pdf[:-1])*np.diff(x)
+        cdf = np.concatenate(([0.0], np.cumsum(area)))
+        if not cdf[-1] > 0:
+            raise ValueError("the distribution has a null integral between %g and %g" % (x[0], x[-1]))
+        self.x = x
+        self.cdf = cdf/cdf[-1]
+
+    @classmethod
+    def fromFunction(cls, function, xmin, xmax, npoints=2000):
+        """Tabulate a python function that accepts and returns numpy arrays"""
+        x = np.linspace(xmin, xmax, npoints)
+        return cls(x, function(x))
+
+    @classmethod
+    def fromTF1(cls, formula, xmin, xmax, npoints=2000):
+        """Tabulate a ROOT formula. ROOT is needed only to build the table, not to sample from it."""
+        import ROOT
+        f1 = ROOT.TF1("f1", formula, xmin, xmax)
+        x = np.linspace(xmin, xmax, npoints)
+        return cls(x, [f1.Eval(xi) for xi in x])
+
+    def inverse(self, u):
+        """Value of the inverse cumulative distribution for the uniform numbers u in [0, 1]"""
+        return np.interp(u, self.cdf, self.x)
+
+    def sample(self, n, rng=np.random):
+        """Returns an array of n random numbers following the distribution.
+
+           rng is the random generator used to draw the uniform numbers (by default the global numpy one)."""
+        return self.inverse(rng.uniform(size=n))
+
+
+_samplers = {}
+
+
+def getSampler(key, factory):
+    """Registry of the samplers of the process.
+
+       Returns the sampler stored with the given key. The first time a key is requested, the sampler
+       is built calling factory() and stored, so each table is computed only once per process."""
+    try:
+        return _samplers[key]
+    except KeyError:
+        sampler = _samplers[key] = factory()
+        return sampler
+
+
+_landau_p1 = (0.4259894875, -0.1249762550, 0.03984243700, -0.006298287635, 0.001511162253)
+_landau_q1 = (1.0, -0.3388260629, 0.09594393323, -0.01608042283, 0.003778942063)
+_landau_p2 = (0.1788541609, 0.1173957403, 0.01488850518, -0.001394989411, 0.0001283617211)
+_landau_q2 = (1.0, 0.7428795082, 0.3153932961, 0.06694219548, 0.008790609714)
+_landau_p3 = (0.1788544503, 0.09359161662, 0.006325387654, 0.00006611667319, -0.000002031049101)
+_landau_q3 = (1.0, 0.6097809921, 0.2560616665, 0.04746722384, 0.006957301675)
+_landau_p4 = (0.9874054407, 118.6723273, 849.2794360, -743.7792444, 427.0262186)
+_landau_q4 = (1.0, 106.8615961, 337.6496214, 2016.712389, 1597.063511)
+_landau_p5 = (1.003675074, 167.5702434, 4789.711289, 21217.86767, -22324.94910)
+_landau_q5 = (1.0, 156.9424537, 3745.310488, 9834.698876, 66924.28357)
+_landau_p6 = (1.000827619, 664.9143136, 62972.92665, 475554.6998, -5743609.109)
+_landau_q6 = (1.0, 651.4101098, 56974.73333, 165917.4725, -2815759.939)
+_landau_a1 = (0.04166666667, -0.01996527778, 0.02709538966)
+_landau_a2 = (-1.845568670, -4.284640743)
+
+
+def _ratio(p, q, v):
+    return np.polyval(p[::-1], v)/np.polyval(q[::-1], v)
+
+
+def landau(x, mpv=0.0, sigma=1.0):
+    """Landau density, the numpy version of TMath::Landau(x, mpv, sigma, 0).
+
+       It uses the same rational approximations of the CERNLIB routine DENLAN used by ROOT.
+       As in ROOT, the result is not divided by sigma."""
+    v = (np.asarray(x, dtype=float)-mpv)/sigma
+    den = np.zeros(v.shape)
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        r = v < -5.5
+        u = np.exp(v[r]+1.0)
+        den[r] = np.where(u < 1e-10, 0.0,
+                          0.3989422803*(np.exp(-1/u)/np.sqrt(u))*(1+(_landau_a1[0]+(_landau_a1[1]+_landau_a1[2]*u)*u)*u))
+        r = (v >= -5.5) & (v < -1)
+        u = np.exp(-v[r]-1)
+        den[r] = np.exp(-u)*np.sqrt(u)*_ratio(_landau_p1, _landau_q1, v[r])
+        r = (v >= -1) & (v < 1)
+        den[r] = _ratio(_landau_p2, _landau_q2, v[r])
+        r = (v >= 1) & (v < 5)
+        den[r] = _ratio(_landau_p3, _landau_q3, v[r])
+        for low, high, p, q in ((5, 12, _landau_p4, _landau_q4),
+                                (12, 50, _landau_p5, _landau_q5),
+                                (50, 300, _landau_p6, _landau_q6)):
+            r = (v >= low) & (v < high)
+            u = 1/v[r]
+            den[r] = u*u*_ratio(p, q, u)
+        r = v >= 300
+        u = 1/(v[r]-v[r]*np.log(v[r])/(v[r]+1))
+        den[r] = u*u*(1+(_landau_a2[0]+_landau_a2[1]*u)*u)
+    return den
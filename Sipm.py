@@ -7,11 +7,10 @@
 """
 import numpy as np
 import math
-import random
-import ROOT
-from AngularDistribution import choose_angle_from_distribution
+from AngularDistribution import choose_angles_from_distribution, getAngleTable, RADIUS_BINS
+import Instrumentation
+import Kernels
 #import AngularDistribution
-import FiberSetup
 
 
 
@@ -21,7 +20,8 @@ class ChannelArray(object):
          The SiPM detector is described as an array of channels. The number of channel is given by the attribute
          channel_number.For each channel the dimentions are defined. Each channel consists of a certain number of pixels,
          whose dimensions are defined also with some class attributes. The most important attibutes of the class are:
-         the list self.pixels, a matrix of boolean value. All the elements, by default, are assigned as False. The
+         the array self.pixels, a numpy matrix of boolean value (pixel_x_size*channel_number x pixel_y_size). All the elements, by default, are assigned as False (with pixel_mode = 'sparse' the
+	 matrix is not allocated and only the fired pixels are kept). The
 	 value becames True if a pixel is fired by the photon.
 	 the array pixel_lit_per_channel,an array with a size given by the total number oh channel. The elements, equal to zero by default,
          are filled with the nymber of pixels fired per channel.
@@ -31,9 +31,13 @@ class ChannelArray(object):
     #        self, name="Sipm", channel_number=128, channel_width=250e-06,
     #        channel_height=1.5e-03, dead_zone=5e-06, epoxy=120e-06, pixel_x_size=4, pixel_y_size=20,
     #        prob_pde=0.25):
-    def __init__(self, parameter):
+    def __init__(self, parameter, rng=np.random, instrumentation=Instrumentation.NULL):
         
         self.param=parameter
+        self.rng = rng
+        # random generator of the photon transport (numpy.random or a numpy.random.RandomState)
+        self.instrumentation = instrumentation
+        # counters of the photons lost, see :mod:`Instrumentation`
         
         #self.channel_number = channel_number
         self.channel_number = self.param.channel_number
@@ -56,13 +60,21 @@ class ChannelArray(object):
         self.pixel_width = self.channel_width/self.pixel_x_size
         self.pixel_height = self.channel_height/self.pixel_y_size
         self.epoxy_index = self.param.epoxy_index
+        self.backend = Kernels.getBackend(getattr(self.param, 'transport_backend', 'numpy'))
+        # 'numpy' for the array functions of this class, 'numba' for the compiled loops of :mod:`Kernels`
         
 
-        self.pixels = [[ False for j in range(self.pixel_y_size)] for i in range(self.pixel_x_size*self.channel_number)]
-        #print len( self.pixels)
-        #print self.pixel_x_size*self.channel_number
-        #self.pixels = [[ False for j in range(4)] for i in range(3)]
-        # containing all the pixels
+        self.pixel_mode = getattr(self.param, 'pixel_mode', 'dense')
+        if self.pixel_mode not in ('dense', 'sparse'):
+            raise ValueError("unknown pixel mode '%s'" % self.pixel_mode)
+        self.pixels = None
+        if self.pixel_mode == 'dense':
+            self.pixels = np.zeros((self.pixel_x_size*self.channel_number, self.pixel_y_size), dtype=bool)
+        # containing all the pixels, None in the sparse mode
+        self.fired_pixels = []
+        # (x, y) indices of the pixels fired since the last reset, the only ones to clean in resetArray
+        self.fired_channels = np.zeros(0, dtype=int)
+        # channels counted by fillChannelArray in the sparse mode, the only ones to clean in resetArray
 
         self.pixel_lit_per_channel = np.zeros(self.channel_number, dtype=int)
         #print self.channel_number
@@ -73,105 +85,175 @@ class ChannelArray(object):
         This method, calculating the position of the photon when it arrives at the SiPM. According to the position,
         the correspondant pixel in the channel is fired, with a probability given by the Photon Detection Efficiency (pde),
         A random number is generated ( between 0 an 1 uniformly); if this number is lower than the pde value, the pixel is
-        fired and the correspondant element in the list pixels is assigned as True. This method is called in the function :func:`simulateParticle`,
-        from :mod:`FiberSetup`, :class:`Setup`.
+        fired and the correspondant element in the array pixels is assigned as True.
+        The photons of the fiber are transported all together by :func:`transportPhotons`.
         
         """
-        # Recover number of photons produced by the fiber        
-        photons =Fiber.photons
-        # For all the produced photons, generate a random position in the fiber
-        for i in range (photons):
-            
-            position = self.getPhotonPosition(Fiber) 
-            # beware this position is in coordinates, the following step is to find the corresponding pixel
-            
-            x_pixel = int(position[0]/self.pixel_width)
-            y_pixel = int(position[1]/self.pixel_height)
-
-           # print  x_pixel,  y_pixel
-            if x_pixel<(self.pixel_x_size*self.channel_number) and x_pixel>=0 and  y_pixel<self.pixel_y_size and y_pixel>=0:
-                if random.random > self.prob_pde:
-                    self.pixels[x_pixel][y_pixel]= True
-
-    def getPhotonPosition(self, Fiber):
+        x_pixel, y_pixel = self.transportPhotons([Fiber.Xc], [Fiber.Yc], [Fiber.diameter], [Fiber.core_index], [Fiber.photons])
+        self.firePixels(x_pixel, y_pixel)
+
+    def fillStackPixels(self, fiber_stack):
+        """Fire the pixels hit by the photons of all the fibers of a :class:`FiberSetup.FiberStack`.
+
+        Only the fibers hit by the track (the attribute hit_fibers of the stack) are considered, the photons of all of them
+        are transported with one call of :func:`transportPhotons` and the pixels are fired with a single assignment. This method
+        is called in the function :func:`simulateParticle`, from :mod:`FiberSetup`, :class:`Setup`."""
+        hit = fiber_stack.hit_fibers
+        x_pixel, y_pixel = self.transportPhotons(fiber_stack.Xc.flat[hit], fiber_stack.Yc.flat[hit], fiber_stack.diameter.flat[hit],
+                                                 fiber_stack.core_index.flat[hit], fiber_stack.photons.flat[hit])
+        self.firePixels(x_pixel, y_pixel)
+
+    def transportPhotons(self, Xc, Yc, diameter, core_index, photons, rng=None, return_source=False):
+        """Transport to the SiPM the photons produced in a set of fibers.
+
+        The fibers are given as arrays of centers, diameters, core indices and numbers of photons. Each fiber is repeated
+        once per photon, then the positions of all the photons are computed by :func:`getPhotonPositions`.
+        The photons are kept if they pass the epoxy layer, if the pixel is inside the detector and if a uniform random number
+        is lower than the pde. Returns the arrays (x_pixel, y_pixel) of the pixels fired by the photons kept and, if return_source
+        is True, the array with the index of the fiber (in the input arrays) of each of these photons.
+        The random numbers are drawn from rng, by default the random generator of the channel array.
+        With the numba backend the photons are transported by :func:`Kernels.transportPhotons`, with the same random numbers."""
+        rng = self.rng if rng is None else rng
+        photons = np.asarray(photons, dtype=int)
+        if self.backend == 'numba':
+            cdf, angles = getAngleTable()
+            x_pixel, y_pixel, source, lost = Kernels.transportPhotons(self, Xc, Yc, diameter, core_index, photons,
+                                                                      rng.uniform(size=(5, photons.sum())), cdf, angles, RADIUS_BINS)
+            if self.instrumentation.enabled:
+                for name, number in zip(('photons_lost_epoxy', 'photons_lost_bounds', 'photons_lost_pde'), lost):
+                    self.instrumentation.count(name, number)
+            if return_source:
+                return x_pixel, y_pixel, source
+            return x_pixel, y_pixel
+        source = np.repeat(np.arange(len(photons)), photons)
+        Xc, Yc, diameter, core_index = [np.repeat(np.asarray(a, dtype=float), photons) for a in (Xc, Yc, diameter, core_index)]
+        xp, yp, refracted = self.getPhotonPositions(Xc, Yc, diameter, core_index, rng)
+        # beware these positions are in coordinates, the following step is to find the corresponding pixels.
+        # astype(int) truncates toward zero like int()
+        with np.errstate(invalid='ignore'):
+            x_pixel = np.where(refracted, xp/self.pixel_width, 0).astype(int)
+            y_pixel = np.where(refracted, yp/self.pixel_height, 0).astype(int)
+        inside = (x_pixel>=0) & (x_pixel<self.pixel_x_size*self.channel_number) & (y_pixel>=0) & (y_pixel<self.pixel_y_size)
+        detected = rng.uniform(size=len(xp)) < self.prob_pde
+        kept = refracted & inside & detected
+        if self.instrumentation.enabled:
+            self.instrumentation.count('photons_lost_epoxy', len(refracted)-np.count_nonzero(refracted))
+            self.instrumentation.count('photons_lost_bounds', np.count_nonzero(refracted & ~inside))
+            self.instrumentation.count('photons_lost_pde', np.count_nonzero(refracted & inside & ~detected))
+        if return_source:
+            return x_pixel[kept], y_pixel[kept], source[kept]
+        return x_pixel[kept], y_pixel[kept]
+
+    def firePixels(self, x_pixel, y_pixel):
+        """Set as fired the pixels with coordinates (x_pixel, y_pixel), numbers or arrays of pixel indices.
+        A pixel fired more than once is still one fired pixel. In the sparse mode the pixels are only recorded in fired_pixels."""
+        if self.pixels is not None:
+            self.pixels[x_pixel, y_pixel] = True
+        self.fired_pixels.append((x_pixel, y_pixel))
+
+    def getPhotonPositions(self, FCx, FCy, diameter, core_index, rng=None):
         """
-        Given a Fiber, returns  a  position for the photon. 
+        Given the arrays of center, diameter and core index of the fiber of each photon, returns the positions of the photons.
 
         .. warning::
 
                 This method is not part of the Fiber class because it also takes into account the epoxy 
                 thickness between the fiber and  the channel, so an additionnal diffraction effects has to be taken 
 		into account.
-        The position of the photon in the fiber surface is generated randomly. In order to  calculate the position in the space
-        the angle of emission is computed calling the function :func:`getThetaPrime`.
-	     
+        The position of each photon in the fiber surface is generated randomly. In order to  calculate the position in the space
+        the angle of emission is computed calling the function :func:`getThetaPrimes`.
+        Returns the arrays (xp, yp, refracted): refracted is False for the photons reflected by the epoxy layer, whose position is nan.
 
         """
-        # Recover values of the current fiber
-        FCx, FCy, diameter = Fiber.Xc, Fiber.Yc, Fiber.diameter
+        rng = self.rng if rng is None else rng
+        n = len(FCx)
+        phi=rng.uniform(size=n)*math.pi
+        phi_prime=rng.uniform(size=n)*math.pi
+        radius=rng.uniform(size=n)*diameter/2.
+        theta_prime=self.getThetaPrimes(radius, core_index, rng)
+        xp=FCx+radius*np.cos(phi)+np.cos(phi_prime)*np.sin(theta_prime)*self.epoxy
+        yp=FCy+radius*np.sin(phi)+self.channel_height/2.0+np.sin(phi_prime)*np.sin(theta_prime)*self.epoxy
 
-        phi=random.random()*math.pi
-        phi_prime=random.random()*math.pi
-        radius=random.random()*diameter/2.
-        theta_prime=self.getThetaPrime(radius)
-        xp=FCx+radius*math.cos(phi)+math.cos(phi_prime)*math.sin(theta_prime)*self.epoxy
-        yp=FCy+radius*math.sin(phi)+self.channel_height/2.0+math.sin(phi_prime)*math.sin(theta_prime)*self.epoxy
+        return xp, yp, ~np.isnan(theta_prime)
 
-        return [xp, yp]
+    def getPhotonPosition(self, Fiber):
+        """
+        Given a Fiber, returns  a  position [xp, yp] for one photon, computed by :func:`getPhotonPositions`.
+        """
+        xp, yp, refracted = self.getPhotonPositions(np.array([Fiber.Xc]), np.array([Fiber.Yc]), Fiber.diameter, Fiber.core_index)
+        return [xp[0], yp[0]]
 
-    def getThetaPrime(self,radius): #it has to be modified using a module?
-        """The emission angle of photons is calculated.
+    def getThetaPrimes(self, radius, core_index, rng=None):
+        """The emission angles of photons are calculated.
 
-	   The angle is calculated calling the function :func:`AngularDistribution.choose_angle_from_distribution`, from :mod:`AngularDistribution`.
+	   The angles are calculated calling the function :func:`AngularDistribution.choose_angles_from_distribution`, from :mod:`AngularDistribution`,
+	   with the radius (in m) converted to um, the unit of the radius bins of the angular distributions.
 	   The angle of emission is then recalculated taking into account the different refraction index between fiber and the epoxy layer,
-	   used to fix the Sipm detector"""
-        core_index = FiberSetup.Fiber().core_index
-        angle_emission = choose_angle_from_distribution(radius)
-        theta_prime = math.asin(core_index/ self.epoxy_index*math.sin(angle_emission)) # The angle of emission after the epoxy layer calculated with the Snell law.
-        return theta_prime
+	   used to fix the Sipm detector. The angle is nan for the photons totally reflected (the sine of the angle after the epoxy layer would be greater than one)."""
+        rng = self.rng if rng is None else rng
+        angle_emission = choose_angles_from_distribution(np.asarray(radius)*1000000, rng)
+        sin_theta_prime = core_index/self.epoxy_index*np.sin(angle_emission) # The angle of emission after the epoxy layer calculated with the Snell law.
+        with np.errstate(invalid='ignore'):
+            return np.arcsin(sin_theta_prime)
+
+    def getThetaPrime(self, radius, core_index=None):
+        """The emission angle of one photon, computed by :func:`getThetaPrimes`. By default the core index is :data:`FiberSetup.CORE_INDEX`."""
+        if core_index is None:
+            import FiberSetup   # imported here, FiberSetup imports this module
+            core_index = FiberSetup.CORE_INDEX
+        return float(self.getThetaPrimes(np.array([radius]), core_index)[0])
 
     def fillChannelArray(self):
         """
         Method to interface with the C++ class
 
-        It fills the pixel_lit_per_channel array according to the pixels array.If a pixel is fired (an element of the pixels matrix has the value 'True',
-        the corresponding channel is calculated and the number of pixels fired of that channel is incremented by one.
+        It fills the pixel_lit_per_channel array according to the pixels array. The rows of the pixels matrix of the same channel
+        are contiguous, so with a reshape each channel becomes one row of pixel_x_size*pixel_y_size pixels and the number of
+        pixels fired (elements with the value 'True') per channel is counted with one sum.
+        With the numba backend the pixels are counted by :func:`Kernels.countChannelPixels`.
+        In the sparse mode (parameter pixel_mode = 'sparse') there is no pixels matrix: the linear indices of the fired pixels
+        are deduplicated with np.unique and counted per channel, so the cost depends on the pixels fired and not on the size
+        of the detector.
         """
-        for j in range (self.pixel_y_size):
-            for i in range (self.pixel_x_size*self.channel_number):
-                if self.pixels[i][j]==True:
-                    self.pixel_lit_per_channel[i/4] += 1  
-        #print self.pixel_lit_per_channel
-        #print self.pixel_x_size*self.channel_number 
+        if self.pixels is None:
+            if self.fired_pixels:
+                x_pixel, y_pixel = [np.concatenate([np.ravel(pixels[i]) for pixels in self.fired_pixels]) for i in (0, 1)]
+                fired = np.unique(np.asarray(x_pixel, dtype=int)*self.pixel_y_size+y_pixel)
+                self.fired_channels, counts = np.unique(fired//(self.pixel_x_size*self.pixel_y_size), return_counts=True)
+                self.pixel_lit_per_channel[self.fired_channels] = counts
+            return
+        if self.backend == 'numba':
+            Kernels.countChannelPixels(self)
+            return
+        pixels_per_channel = self.pixels.reshape(self.channel_number, self.pixel_x_size*self.pixel_y_size)
+        self.pixel_lit_per_channel[:] = np.count_nonzero(pixels_per_channel, axis=1)
+
+    def countFiredPixels(self, event, x_pixel, y_pixel, nevents):
+        """Digitization of a block of events without the pixels matrix.
+
+        Given for each detected photon the event and the pixel (x_pixel, y_pixel), returns the matrix (nevents x channel_number)
+        with the number of pixels fired per channel. A pixel hit by more than one photon of the same event is counted once.
+        With the numba backend the pixels are counted by :func:`Kernels.countFiredPixels`."""
+        if self.backend == 'numba':
+            return Kernels.countFiredPixels(self, event, x_pixel, y_pixel, nevents)
+        pixels_per_event = self.pixel_x_size*self.channel_number*self.pixel_y_size
+        fired = np.unique((np.asarray(event)*(self.pixel_x_size*self.channel_number)+x_pixel)*self.pixel_y_size+y_pixel)
+        event, pixel = np.divmod(fired, pixels_per_event)
+        channel = pixel//(self.pixel_x_size*self.pixel_y_size)
+        counts = np.bincount(event*self.channel_number+channel, minlength=nevents*self.channel_number)
+        return counts.reshape(nevents, self.channel_number)
 
     def resetArray(self):
         """
-        Method to reset the pixel and channel array for each event """
-
-        print 'reset of the matrix'
-        
-        for j in range (self.pixel_y_size):
-            for i in range (self.pixel_x_size*self.channel_number):
-                self.pixels[i][j]= False
-                self.pixel_lit_per_channel[i/4]=0  
-
-        
-
-
-
- 
-        
-
-
-
-
-    
-
-     
-        
-    
-       
-    
-
-
-
+        Method to reset the pixel and channel array for each event.
+        Only the pixels fired during the event are set back to False, and in the sparse mode only the channels counted."""
+
+        if self.pixels is None:
+            self.pixel_lit_per_channel[self.fired_channels] = 0
+            self.fired_channels = np.zeros(0, dtype=int)
+            self.fired_pixels = []
+            return
+        for x_pixel, y_pixel in self.fired_pixels:
+            self.pixels[x_pixel, y_pixel] = False
+        self.fired_pixels = []
+        self.pixel_lit_per_channel.fill(0)
@@ -0,0 +1,188 @@
+# Statistics module
+
+"""
+.. module:: Statistics
+   :synopsis: Summary statistics accumulated during the run
+
+The accumulators are updated with each event or block of events and keep only their bins, so their memory
+does not depend on the number of events. The accumulators of different processes are added with merge: all
+of them are made of integer counts and sums, so the merge is exact and a run split in several processes gives
+the same statistics of a run in one process.
+"""
+import json
+import numpy as np
+
+
+class Histogram(object):
+    """Histogram with fixed bin edges, with underflow and overflow.
+
+       counts[0] is the underflow, counts[i] the number of values in [edges[i-1], edges[i]) and counts[-1] the overflow."""
+
+    def __init__(self, edges):
+
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges)+1, dtype=np.int64)
+
+    def fill(self, values):
+        self.counts += np.bincount(np.searchsorted(self.edges, np.ravel(values), side='right'), minlength=len(self.counts))
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("the histograms have different bins")
+        self.counts += other.counts
+
+    def summary(self):
+        return {'edges': self.edges.tolist(), 'counts': self.counts.tolist()}
+
+    def load(self, summary):
+        """Restore the counts of a :func:`summary`"""
+        self.edges = np.array(summary['edges'], dtype=float)
+        self.counts = np.array(summary['counts'], dtype=np.int64)
+
+
+class Moments(object):
+    """Number of values, mean and variance of nbins samples of integer values.
+
+       The samples are accumulated as the exact integer sums of the values and of their squares, so the result does
+       not depend on how the values are split in blocks or in processes and the merge is exact; the mean and the
+       variance are computed from the sums only when they are requested."""
+
+    def __init__(self, nbins=1):
+
+        self.n = np.zeros(nbins, dtype=np.int64)
+        self.sum = np.zeros(nbins, dtype=np.int64)
+        self.sum2 = np.zeros(nbins, dtype=np.int64)
+
+    def update(self, values, bins=0):
+        """Add the values, values[i] to the sample bins[i] (an array, or one bin for all the values)"""
+        values = np.ravel(values).astype(np.int64)
+        bins = np.broadcast_to(bins, values.shape)
+        nbins = len(self.n)
+        self.n += np.bincount(bins, minlength=nbins)
+        # np.bincount sums in floats, exact for the integer sums of one block (lower than 2**53)
+        self.sum += np.rint(np.bincount(bins, values, minlength=nbins)).astype(np.int64)
+        self.sum2 += np.rint(np.bincount(bins, values*values, minlength=nbins)).astype(np.int64)
+
+    def merge(self, other):
+        self.n += other.n
+        self.sum += other.sum
+        self.sum2 += other.sum2
+
+    @property
+    def mean(self):
+        return self.sum/np.maximum(self.n, 1).astype(float)
+
+    def variance(self):
+        """Unbiased variance of each sample, nan if it has less than two values"""
+        n = self.n.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n > 1, (self.sum2-self.sum*self.mean)/(n-1), np.nan)
+
+    def summary(self):
+        return {'n': self.n.tolist(), 'sum': self.sum.tolist(), 'sum2': self.sum2.tolist(),
+                'mean': self.mean.tolist(), 'variance': [None if np.isnan(v) else v for v in self.variance()]}
+
+    def load(self, summary):
+        self.n = np.array(summary['n'], dtype=np.int64)
+        self.sum = np.array(summary['sum'], dtype=np.int64)
+        self.sum2 = np.array(summary['sum2'], dtype=np.int64)
+
+
+class RunStatistics(object):
+    """Statistics of a run:
+
+       - occupancy: for each channel, the pixels fired and the number of events with at least one pixel fired;
+       - multiplicity: histogram of the pixels fired per event, one bin for each number up to max_pixels and the
+         larger numbers in the overflow, so its size does not grow with the pixels of the detector;
+       - response_vs_theta: mean and variance of the pixels fired per event in ntheta bins of theta;
+       - photons_vs_impact: mean and variance of the photons of the hit fibers in each bin of the impact
+         parameter (:data:`FiberSetup.IMPACT_BINS`), and photons: histogram of the photons per hit fiber.
+
+       The events are added with :func:`update`, the hit fibers by the setup with :func:`fillFibers`."""
+
+    enabled = True
+
+    def __init__(self, channel_number, max_pixels, theta_max, nimpact_bins, ntheta=20):
+
+        self.fired_pixels = np.zeros(channel_number, dtype=np.int64)
+        self.fired_events = np.zeros(channel_number, dtype=np.int64)
+        self.multiplicity = Histogram(np.arange(max_pixels+2))
+        self.theta_edges = np.linspace(0.0, theta_max, ntheta+1)
+        self.response_vs_theta = Moments(ntheta)
+        self.photons_vs_impact = Moments(nimpact_bins)
+        self.photons = Histogram(np.arange(201))
+        self.nevents = 0
+
+    def update(self, theta, X0, response):
+        """Add a block of events: the arrays theta and X0 and the matrix (events x channel_number) of the pixels fired per channel"""
+        response = np.asarray(response)
+        total = response.sum(axis=1)
+        self.fired_pixels += response.sum(axis=0)
+        self.fired_events += np.count_nonzero(response, axis=0)
+        self.multiplicity.fill(total)
+        # with pile-up an event without tracks has theta nan, and it is not in response_vs_theta
+        tracks = ~np.isnan(theta)
+        bins = np.clip(np.searchsorted(self.theta_edges, np.asarray(theta)[tracks], side='right')-1, 0, len(self.theta_edges)-2)
+        self.response_vs_theta.update(total[tracks], bins)
+        self.nevents += len(total)
+
+    def fillFibers(self, impact_bins, photons):
+        """Add the hit fibers, given their bins of impact parameter and their photons"""
+        self.photons_vs_impact.update(photons, impact_bins)
+        self.photons.fill(photons)
+
+    def accumulators(self):
+        return {'multiplicity': self.multiplicity, 'response_vs_theta': self.response_vs_theta,
+                'photons_vs_impact': self.photons_vs_impact, 'photons': self.photons}
+
+    def merge(self, other):
+        self.fired_pixels += other.fired_pixels
+        self.fired_events += other.fired_events
+        for name, accumulator in self.accumulators().items():
+            accumulator.merge(other.accumulators()[name])
+        self.nevents += other.nevents
+
+    def occupancy(self):
+        """Fraction of the events in which each channel has at least one pixel fired"""
+        return self.fired_events/float(max(self.nevents, 1))
+
+    def summary(self):
+        summary = dict((name, accumulator.summary()) for name, accumulator in self.accumulators().items())
+        summary.update({'nevents': self.nevents, 'fired_pixels': self.fired_pixels.tolist(),
+                        'fired_events': self.fired_events.tolist(), 'theta_edges': self.theta_edges.tolist()})
+        return summary
+
+    def load(self, summary):
+        """Restore the statistics of a :func:`summary`, for example to continue a run"""
+        for name, accumulator in self.accumulators().items():
+            accumulator.load(summary[name])
+        self.nevents = summary['nevents']
+        self.fired_pixels = np.array(summary['fired_pixels'], dtype=np.int64)
+        self.fired_events = np.array(summary['fired_events'], dtype=np.int64)
+        self.theta_edges = np.array(summary['theta_edges'])
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+
+class NullStatistics(RunStatistics):
+    """Statistics that do nothing, used when the statistics are disabled"""
+
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def update(self, theta, X0, response):
+        pass
+
+    def fillFibers(self, impact_bins, photons):
+        pass
+
+    def merge(self, other):
+        pass
+
+
+NULL = NullStatistics()
+"""Disabled statistics, the default of the classes of the simulation"""
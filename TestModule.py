@@ -1,13 +1,439 @@
 import unittest
 import numpy
+import os
+import shutil
+import tempfile
 import FiberSetup
 import MainSimulation
+import Sampling
+import AngularDistribution
+import Sipm
+import OutputWriter
+import Instrumentation
+import ParameterSweep
+import RandomService
+import GenerateEvent
+import Statistics
+import Reconstruction
+import Pipeline
+import Checkpoint
+import json
+import FastSimulation
 
 
 class FiberclassTestCase (unittest.TestCase):
 
-    def test
-    pass
+    def test_standalone_fiber(self):
+        fiber=FiberSetup.Fiber(1e-3, 2e-3)
+        self.assertEqual((fiber.Xc, fiber.Yc, fiber.diameter, fiber.core_index, fiber.photons), (1e-3, 2e-3, 250e-06, 1.59, 0))
+
+    def test_fiber_is_a_view_on_the_stack(self):
+        stack=FiberSetup.FiberStack(3, 4)
+        stack[1][2].photons=7
+        stack[2, 3].Xc=5e-3
+        self.assertEqual(stack.photons[1, 2], 7, msg='photons not written in the stack array')
+        self.assertEqual(stack.Xc[2, 3], 5e-3, msg='Xc not written in the stack array')
+        stack.resetPhotons()
+        self.assertEqual(stack[1][2].photons, 0, msg='reset of the stack not seen by the fiber view')
+
+    def test_stack_impact_matches_fiber_impact(self):
+        stack=FiberSetup.FiberStack(2, 3)
+        stack.Xc[:]=numpy.arange(6).reshape(2, 3)*280e-06
+        stack.Yc[1]=216e-06
+        impact=stack.getImpact(0.03, 300e-06, 0)
+        for layer in range(2):
+            for nfiber in range(3):
+                self.assertAlmostEqual(impact[layer, nfiber], stack[layer][nfiber].getImpact(0.03, 300e-06, 0), places=15)
+
+    def test_candidates_contain_all_hit_fibers(self):
+        parameter=MainSimulation.Parameters('config.py')
+        stack=FiberSetup.Setup(parameter).fiber_stack
+        random_state=numpy.random.RandomState(2)
+        for i in range(200):
+            theta, X0=random_state.uniform(-0.1, 0.1), random_state.uniform(0, 0.032)
+            hit=numpy.flatnonzero(stack.getImpact(theta, X0, 0)<=stack.diameter/2)
+            candidates=stack.getCandidateIndices(theta, X0, 0)
+            self.assertTrue(numpy.in1d(hit, candidates).all(), msg='hit fiber missing in the candidates')
+            self.assertLessEqual(len(candidates), 2*stack.shape[0], msg='too many candidates for a track')
+
+    def test_crosstalk_neighbours(self):
+        stack=FiberSetup.FiberStack(2, 5, 1.0)
+        stack.Xc[:]=numpy.arange(5)*1.1
+        stack.Yc[1]=1.0
+        stack.buildIndex()
+        stack.buildCrossTalk(0.5, 1.1)
+        self.assertListEqual(sorted(stack.crosstalk_neighbours[stack.crosstalk_start[2]:stack.crosstalk_start[3]]), [1, 3, 7])
+        source, fiber, photons=stack.getCrossTalk([2], [1000], numpy.random.RandomState(1))
+        self.assertListEqual(sorted(fiber), [1, 3, 7])
+        self.assertTrue((abs(photons-500)<100).all(), msg='cross-talk photons out of range')
+
+    def test_yield_bins(self):
+        bins=FiberSetup.getYieldBin([0, 25e-06, 26e-06, 100e-06, 125e-06])
+        self.assertListEqual(list(bins), [0, 0, 1, 3, 4], msg='impact parameter assigned to the wrong yield bin')
+
+class SamplingTestCase (unittest.TestCase):
+
+    def test_inverse_cdf_sampler(self):
+        sampler=Sampling.InverseCDFSampler.fromFunction(lambda x: numpy.exp(-0.5*((x-22.1398)/6.16924)**2), 0, 50)
+        values=sampler.sample(100000, numpy.random.RandomState(1))
+        self.assertTrue(values.min()>=0 and values.max()<=50, msg='sampled values out of the range of the distribution')
+        self.assertAlmostEqual(values.mean(), 22.14, delta=0.1)
+        self.assertAlmostEqual(values.std(), 6.17, delta=0.1)
+
+    def test_sampler_registry(self):
+        self.assertIs(FiberSetup.getYieldSampler(1), FiberSetup.getYieldSampler(1), msg='yield sampler built twice')
+
+    def test_landau_peak(self):
+        x=numpy.linspace(-5, 5, 10001)
+        self.assertAlmostEqual(x[Sampling.landau(x).argmax()], -0.2228, delta=1e-3)
+
+
+class AngularDistributionTestCase (unittest.TestCase):
+
+    def test_angles_follow_radius_bins(self):
+        radius=numpy.array([5.0, 12.5, 70.0, 120.0, 130.0, -1.0])
+        angles=numpy.degrees(AngularDistribution.choose_angles_from_distribution(numpy.repeat(radius, 1000)).reshape(6, 1000))
+        self.assertLessEqual(angles[0].max(), 27, msg='angle out of the range of function_1')
+        self.assertLessEqual(angles[1].max(), 27, msg='radius 12.5 must use function_1')
+        self.assertLessEqual(angles[2].max(), 37, msg='angle out of the range of function_6')
+        self.assertGreater(angles[3].max(), 37, msg='radius 120 must use function_10')
+        self.assertFalse(angles[4:].any(), msg='radius out of the fiber must give a null angle')
+
+
+class ChannelArrayTestCase (unittest.TestCase):
+
+    def setUp(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.channel_number=8
+        parameter.pixel_x_size=2
+        parameter.pixel_y_size=3
+        self.channel_array=Sipm.ChannelArray(parameter)
+
+    def test_fired_pixels_per_channel(self):
+        self.channel_array.firePixels(numpy.array([0, 1, 1, 5, 15]), numpy.array([0, 2, 2, 1, 2]))
+        self.channel_array.fillChannelArray()
+        self.assertListEqual(list(self.channel_array.pixel_lit_per_channel), [2, 0, 1, 0, 0, 0, 0, 1])
+
+    def test_count_fired_pixels_per_event(self):
+        counts=self.channel_array.countFiredPixels(numpy.array([0, 0, 0, 2, 2]), numpy.array([0, 0, 1, 15, 3]), numpy.array([1, 1, 2, 2, 0]), 3)
+        self.assertTupleEqual(counts.shape, (3, 8))
+        self.assertListEqual(list(counts[0]), [2, 0, 0, 0, 0, 0, 0, 0], msg='pixel hit twice counted twice')
+        self.assertFalse(counts[1].any())
+        self.assertListEqual(list(counts[2]), [0, 1, 0, 0, 0, 0, 0, 1])
+
+    def test_reset(self):
+        self.channel_array.firePixels(numpy.array([3, 9]), numpy.array([0, 1]))
+        self.channel_array.fillChannelArray()
+        self.channel_array.resetArray()
+        self.assertFalse(self.channel_array.pixels.any(), msg='pixels still fired after the reset')
+        self.assertFalse(self.channel_array.pixel_lit_per_channel.any(), msg='channels not reset')
+
+    def test_sparse_pixels(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.channel_number=8
+        parameter.pixel_x_size=2
+        parameter.pixel_y_size=3
+        parameter.pixel_mode='sparse'
+        channel_array=Sipm.ChannelArray(parameter)
+        self.assertIsNone(channel_array.pixels)
+        channel_array.firePixels(numpy.array([0, 1, 1]), numpy.array([0, 2, 2]))
+        channel_array.firePixels(5, 1)
+        channel_array.firePixels(numpy.array([15, 0]), numpy.array([2, 0]))
+        channel_array.fillChannelArray()
+        self.assertListEqual(list(channel_array.pixel_lit_per_channel), [2, 0, 1, 0, 0, 0, 0, 1])
+        channel_array.resetArray()
+        self.assertFalse(channel_array.pixel_lit_per_channel.any(), msg='channels not reset')
+
+    def test_transport_photons(self):
+        self.channel_array.prob_pde=1.0
+        x_pixel, y_pixel=self.channel_array.transportPhotons([1e-3, 1.5e-3], [0, 0], [250e-06, 250e-06], [1.59, 1.59], [300, 200])
+        self.assertGreater(len(x_pixel), 0, msg='no photon detected with pde=1')
+        self.assertTrue((x_pixel>=0).all() and (x_pixel<16).all() and (y_pixel>=0).all() and (y_pixel<3).all(), msg='pixel out of the detector')
+        self.channel_array.prob_pde=0.0
+        x_pixel, y_pixel=self.channel_array.transportPhotons([1e-3], [0], [250e-06], [1.59], [300])
+        self.assertEqual(len(x_pixel), 0, msg='photon detected with pde=0')
+
+    def test_loop_kernels_match_numpy(self):
+        fibers=([1e-3, 1.5e-3, 3.9e-3], [0, 1e-4, 0], [250e-06, 250e-06, 250e-06], [1.59, 1.59, 1.59], [40, 0, 30])
+        expected=self.channel_array.transportPhotons(*fibers, rng=numpy.random.RandomState(7), return_source=True)
+        counts=self.channel_array.countFiredPixels(expected[2], expected[0], expected[1], 3)
+        self.channel_array.backend='numba'
+        result=self.channel_array.transportPhotons(*fibers, rng=numpy.random.RandomState(7), return_source=True)
+        for expected_array, array in zip(expected, result):
+            numpy.testing.assert_array_equal(array, expected_array)
+        numpy.testing.assert_array_equal(self.channel_array.countFiredPixels(result[2], result[0], result[1], 3), counts)
+
+
+class OutputWriterTestCase (unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.columns=OutputWriter.eventColumns(4)
+        self.response=numpy.arange(20).reshape(5, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeEvents(self, writer):
+        writer.write(0.1, 1e-3, self.response[0])
+        writer.write(numpy.full(4, 0.2), numpy.full(4, 2e-3), self.response[1:])
+        writer.close()
+
+    def test_npz_chunks(self):
+        filename=os.path.join(self.directory, 'result.npz')
+        self.writeEvents(OutputWriter.openWriter('npz', filename, self.columns, flush_every=2))
+        result=OutputWriter.readNpz(filename)
+        self.assertListEqual(list(result['theta']), [0.1, 0.2, 0.2, 0.2, 0.2])
+        self.assertTrue((result['pixel_lit_per_channel']==self.response).all(), msg='response not stored')
+
+    def test_binary_columns(self):
+        filename=os.path.join(self.directory, 'result.bin')
+        self.writeEvents(OutputWriter.openWriter('binary', filename, self.columns, flush_every=3))
+        response=numpy.fromfile(os.path.join(filename, 'pixel_lit_per_channel.bin'), dtype='<i4').reshape(-1, 4)
+        self.assertTrue((response==self.response).all(), msg='response not stored')
+
+    def test_binary_keep_events(self):
+        filename=os.path.join(self.directory, 'result.bin')
+        self.writeEvents(OutputWriter.openWriter('binary', filename, self.columns))
+        writer=OutputWriter.BinaryWriter(filename, self.columns, keep_events=2)
+        writer.write(0.3, 3e-3, self.response[4])
+        writer.close()
+        result=list(OutputWriter.readBinaryChunks(filename, chunk_size=2))
+        self.assertListEqual([len(chunk['theta']) for chunk in result], [2, 1])
+        self.assertListEqual(list(result[1]['theta']), [0.3])
+        self.assertTrue((result[1]['pixel_lit_per_channel']==self.response[4]).all(), msg='events not appended')
+
+    def test_binary_reader(self):
+        filename=os.path.join(self.directory, 'result.bin')
+        self.writeEvents(OutputWriter.openWriter('binary', filename, self.columns, flush_every=2))
+        with OutputWriter.BinaryReader(filename) as reader:
+            self.assertEqual(len(reader), 5)
+            self.assertIsInstance(reader['pixel_lit_per_channel'], numpy.memmap)
+            events=reader[1:3]
+            self.assertTrue((events['pixel_lit_per_channel']==self.response[1:3]).all(), msg='wrong events')
+            chunks=list(reader.iterChunks(2, columns=['theta'], start=1))
+            self.assertListEqual([chunk.keys() for chunk in chunks], [['theta']]*2)
+            self.assertListEqual([len(chunk['theta']) for chunk in chunks], [2, 2])
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, OutputWriter.openWriter, 'csv', None, self.columns)
+
+
+class InstrumentationTestCase (unittest.TestCase):
+
+    def test_merge(self):
+        first, second=Instrumentation.create(True), Instrumentation.create(True)
+        with first.stage('reset'):
+            first.count('photons', 3)
+        second.count('photons', 4)
+        second.addTime('reset', 1.0)
+        first.merge(second)
+        summary=first.summary()
+        self.assertEqual(summary['counters']['photons'], 7)
+        self.assertEqual(summary['stages']['reset']['calls'], 2)
+        self.assertGreaterEqual(summary['stages']['reset']['time'], 1.0)
+
+    def test_disabled(self):
+        instrumentation=Instrumentation.create(False)
+        with instrumentation.stage('reset'):
+            instrumentation.count('photons', 3)
+        self.assertDictEqual(instrumentation.summary(), {'stages': {}, 'counters': {}})
+
+
+class CheckpointTestCase (unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def runSimulation(self, name, checkpoint_every=0, output_format='npz'):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.nevents=400
+        parameter.block_size=50
+        parameter.seed=7
+        parameter.statistics=True
+        parameter.checkpoint_every=checkpoint_every
+        parameter.checkpoint_dir=os.path.join(self.directory, 'scratch')
+        parameter.output_format=output_format
+        parameter.output_file=os.path.join(self.directory, name+'.npz')
+        parameter.statistics_file=os.path.join(self.directory, name+'.json')
+        GenerateEvent.Event(parameter).writeData()
+        with open(parameter.statistics_file) as f:
+            statistics=json.load(f)
+        return OutputWriter.readNpz(parameter.output_file) if output_format=='npz' else None, statistics
+
+    def interruptSimulation(self, output_format='npz'):
+        """Runs the simulation with checkpoints, stopping it after the checkpoint of 300 events"""
+        write=Checkpoint.Checkpoint.write
+        def interruptedWrite(checkpoint, *values):
+            if checkpoint.nevents>=300:
+                raise KeyboardInterrupt
+            write(checkpoint, *values)
+        Checkpoint.Checkpoint.write=interruptedWrite
+        try:
+            self.assertRaises(KeyboardInterrupt, self.runSimulation, 'result', 100, output_format)
+        finally:
+            Checkpoint.Checkpoint.write=write
+        with open(os.path.join(self.directory, 'scratch', 'checkpoint.json')) as f:
+            self.assertEqual(json.load(f)['nevents'], 300)
+
+    def test_resumed_run(self):
+        expected, expected_statistics=self.runSimulation('expected')
+        os.mkdir(os.path.join(self.directory, 'scratch'))
+        with open(os.path.join(self.directory, 'scratch', 'precious.dat'), 'w') as f:
+            f.write('not of the checkpoint')
+        self.interruptSimulation()
+        result, statistics=self.runSimulation('result', 100)
+        for name in expected:
+            numpy.testing.assert_array_equal(result[name], expected[name])
+        self.assertDictEqual(statistics, expected_statistics)
+        self.assertListEqual(os.listdir(os.path.join(self.directory, 'scratch')), ['precious.dat'])
+
+    def test_statistics_only_checkpoint(self):
+        expected, expected_statistics=self.runSimulation('expected', output_format='none')
+        self.interruptSimulation('none')
+        self.assertListEqual(os.listdir(os.path.join(self.directory, 'scratch')), ['checkpoint.json'])
+        result, statistics=self.runSimulation('result', 100, 'none')
+        self.assertDictEqual(statistics, expected_statistics)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'scratch')))
+
+
+class RandomServiceTestCase (unittest.TestCase):
+
+    def test_buffered_stream(self):
+        stream=RandomService.RandomStream(RandomService.createGenerator(1, RandomService.EVENTS, 0), buffer_size=10)
+        values=[stream.uniform() for i in range(5)]+list(stream.uniform(size=20))+list(stream.uniform(size=(2, 3)).ravel())
+        expected=RandomService.createGenerator(1, RandomService.EVENTS, 0).uniform(size=31)
+        numpy.testing.assert_array_equal(values, expected)
+
+    def test_events_do_not_depend_on_the_split(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.block_size=50
+        whole=GenerateEvent.Event(parameter).run(200)
+        simul=GenerateEvent.Event(parameter)
+        parts=[simul.run(100, 100), simul.run(100)]
+        numpy.testing.assert_array_equal(whole[2], numpy.concatenate([parts[1][2], parts[0][2]]))
+
+    def test_parallel_run_is_the_serial_run(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.nevents=200
+        parameter.block_size=50
+        parameter.seed=11
+        serial=GenerateEvent.Event(parameter).run(200)
+        parallel=GenerateEvent.Event(parameter).runParallel(2)
+        for expected, result in zip(serial, parallel):
+            numpy.testing.assert_array_equal(result, expected)
+
+
+class StatisticsTestCase (unittest.TestCase):
+
+    def test_merge_is_exact(self):
+        values=numpy.random.RandomState(3).poisson(20, 1000)
+        bins=numpy.arange(1000)%3
+        whole=Statistics.Moments(3)
+        whole.update(values, bins)
+        parts=Statistics.Moments(3)
+        other=Statistics.Moments(3)
+        parts.update(values[:400], bins[:400])
+        other.update(values[400:], bins[400:])
+        parts.merge(other)
+        numpy.testing.assert_array_equal(parts.mean, whole.mean)
+        numpy.testing.assert_allclose(whole.variance()[0], values[bins==0].var(ddof=1))
+
+    def test_histogram_overflow(self):
+        histogram=Statistics.Histogram([0, 1, 2])
+        histogram.fill([-1, 0, 0.5, 1, 2, 5])
+        self.assertListEqual(histogram.counts.tolist(), [1, 2, 1, 2])
+
+    def test_multiplicity_bins_are_bounded(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.statistics=True
+        parameter.statistics_max_pixels=10
+        simul=GenerateEvent.Event(parameter)
+        theta, X0, response=simul.run(50)
+        counts=simul.statistics.multiplicity.counts
+        self.assertEqual(len(counts), 13)
+        self.assertEqual(counts[-1], numpy.count_nonzero(response.sum(axis=1)>10))
+
+
+class ReconstructionTestCase (unittest.TestCase):
+
+    def test_clusters_and_position(self):
+        response=numpy.array([[0, 2, 3, 0, 1, 0], [0, 0, 0, 0, 0, 0], [5, 0, 0, 0, 4, 4]])
+        clusters=Reconstruction.findClusters(response)
+        self.assertListEqual(clusters['event'].tolist(), [0, 0, 2, 2])
+        self.assertListEqual(clusters['size'].tolist(), [2, 1, 1, 2])
+        events=Reconstruction.reconstructEvents(response, 2.0)
+        numpy.testing.assert_allclose(events['position'], [4.2, numpy.nan, 10.0])
+        self.assertListEqual(events['nclusters'].tolist(), [2, 0, 2])
+        self.assertListEqual(events['charge'].tolist(), [5, 0, 8])
+
+
+class PipelineTestCase (unittest.TestCase):
+
+    def test_order_and_errors(self):
+        pipeline=Pipeline.Pipeline(range(20), [lambda x: x*2, lambda x: x+1], queue_size=1)
+        self.assertListEqual(list(pipeline), [2*x+1 for x in range(20)])
+        def fail(x):
+            if x==5:
+                raise ValueError('stage failed')
+            return x
+        self.assertRaises(ValueError, list, Pipeline.Pipeline(range(20), [fail]))
+
+    def test_pipelined_events(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.block_size=50
+        expected=GenerateEvent.Event(parameter).run(200)
+        parameter.pipeline=True
+        result=GenerateEvent.Event(parameter).run(200)
+        numpy.testing.assert_array_equal(result[2], expected[2])
+
+
+class FastSimulationTestCase (unittest.TestCase):
+
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_templates_are_rebuilt(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.simulation='fast'
+        parameter.fastsim_dir=self.directory
+        parameter.fastsim_samples=20
+        parameter.block_size=100
+        simul=GenerateEvent.Event(parameter)
+        theta, X0, response=simul.run(200)
+        self.assertTupleEqual(response.shape, (200, parameter.channel_number))
+        self.assertGreater(response.sum(), 0)
+        key=simul.templates.key
+        self.assertEqual(FastSimulation.getTemplates(parameter, simul.setup, 1).key, key)
+        parameter.prob_pde=parameter.prob_pde/2
+        self.assertNotEqual(FastSimulation.getTemplates(parameter, simul.setup, 1).key, key)
+        self.assertListEqual(sorted(os.listdir(self.directory)), sorted([key+'.npz', FastSimulation.templateKey(parameter, simul.setup)+'.npz']))
+
+
+class PileupTestCase (unittest.TestCase):
+
+    def test_tracks_of_the_events(self):
+        parameter=MainSimulation.Parameters('config.py')
+        parameter.multiplicity=3
+        theta, X0, response, ntracks, track_theta, track_X0=GenerateEvent.Event(parameter).run(100)
+        self.assertTupleEqual(track_X0.shape, (100, 3))
+        self.assertTrue((ntracks==3).all())
+        numpy.testing.assert_array_equal(X0, track_X0[:, 0])
+        parameter.multiplicity_mode='poisson'
+        parameter.multiplicity=1.0
+        parameter.statistics=True
+        simul=GenerateEvent.Event(parameter)
+        theta, X0, response, ntracks, track_theta, track_X0=simul.run(500)
+        numpy.testing.assert_array_equal(numpy.isfinite(track_theta).sum(axis=1), ntracks)
+        self.assertFalse(response[ntracks==0].any(), msg='pixels fired in an event without tracks')
+        self.assertEqual(simul.statistics.response_vs_theta.n.sum(), numpy.count_nonzero(ntracks))
+
 
 class SetupclassTestCase (unittest.TestCase):
     
@@ -41,6 +467,15 @@ class SetupclassTestCase (unittest.TestCase):
             max_expected_Xc_0_0=0.000125
             self.assertLessEqual(actual_Xc_coordinates0_0,max_expected_Xc_0_0,msg='Xc coordinate of fiber[0][0] is out of range')
 
+    def test_reconfigure_keeps_geometry(self):
+        parameter=MainSimulation.Parameters('config.py')
+        setup=FiberSetup.Setup(parameter)
+        Xc=setup.fiber_stack.Xc.copy()
+        setup.reconfigure(ParameterSweep.configure(parameter, {'prob_pde': 0.5}))
+        self.assertEqual(setup.getObjectChannel().prob_pde, 0.5)
+        numpy.testing.assert_array_equal(setup.fiber_stack.Xc, Xc)
+        self.assertRaises(ValueError, setup.reconfigure, ParameterSweep.configure(parameter, {'fiber_gap': 40e-06}))
+
 
 if __name__== "__main__":
     unittest.main()      
@@ -15,3 +15,35 @@ fiber_gap = 30e-06
 dead_zone = 5e-06
 prob_pde = 0.25
 epoxy_index = 1.52
+seed = 12345   #seed of the random generators, remove it to use a random seed
+nworkers = 1   #number of processes used to generate the events
+block_size = 1000  #number of events simulated together, 0 to simulate the events one by one
+output_format = 'root'   #format of the results: root, npz, hdf5, binary or none
+output_file = 'Result.root'
+flush_every = 10000   #number of events kept in memory before writing them
+instrumentation = False   #True to record the time of each stage and the counters of the run
+instrumentation_file = 'Instrumentation.json'
+checkpoint_every = 0   #number of events between two checkpoints of the run, 0 to disable them
+checkpoint_dir = ''   #directory of the checkpoint, by default the output file followed by .checkpoint
+random_buffer_size = 4096   #largest number of random numbers drawn together by the random streams (the first draws are smaller)
+statistics = False   #True to accumulate the summary statistics of the run
+statistics_file = 'Statistics.json'
+statistics_theta_bins = 20   #number of bins of theta of the statistics
+statistics_max_pixels = 1000   #largest number of pixels fired per event with its own bin in the statistics, the larger ones are in the overflow
+cluster_threshold = 1   #pixels fired for a channel to be part of a cluster in the reconstruction
+crosstalk_prob = 0.0   #probability that a photon of a fiber produces a photon in each neighbour fiber, 0 to disable the cross-talk
+crosstalk_distance = 0   #largest distance of the centers of two neighbour fibers, 0 for the distance of two fibers in the same layer
+pipeline = False   #True to run the generation, the simulation, the digitization and the output of the blocks in parallel threads
+pipeline_queue_size = 4   #number of blocks waiting between two stages of the pipeline
+simulation = 'full'   #'full' to simulate the photons of each event, 'fast' to sample the response from templates of the full simulation
+fastsim_dir = 'FastSimTemplates'   #directory of the templates of the fast simulation, one file for each configuration
+fastsim_theta_bins = 10   #number of bins of theta of the templates
+fastsim_phase_bins = 14   #number of bins of the position of the particle in a fiber pitch
+fastsim_channel_bins = 5   #number of bins of the position of the particle in a channel
+fastsim_samples = 200   #number of events of the full simulation in each bin of the templates
+fastsim_window = 4   #number of channels at each side of the channel of the particle kept in the templates
+transport_backend = 'numpy'   #'numpy' or 'numba' (compiled loops of the photon transport and of the digitization, numpy if numba is not installed)
+pixel_mode = 'dense'   #'dense' to keep the matrix of all the pixels, 'sparse' to keep only the pixels fired (faster for large detectors)
+multiplicity = 1   #particles per event (pile-up): the number of particles, or their mean with multiplicity_mode = 'poisson'
+multiplicity_mode = 'fixed'   #'fixed' or 'poisson'
+max_multiplicity = 0   #largest number of particles of an event with the poisson multiplicity, 0 for multiplicity+5*sqrt(multiplicity)+1